@@ -0,0 +1,111 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class SessionMarks:
+    """Students already checked in to one session, as id sets per status.
+
+    Present and late each get a set; the rare other status is kept in a
+    small dict. Memory follows the number of marks, not the size of the
+    ids. The first status recorded for a student wins.
+    """
+
+    __slots__ = ("_present", "_late", "_other")
+
+    def __init__(self):
+        self._present: Set[int] = set()
+        self._late: Set[int] = set()
+        self._other: Dict[int, str] = {}
+
+    def get(self, student_id: int) -> Optional[str]:
+        if student_id in self._present:
+            return "present"
+        if student_id in self._late:
+            return "late"
+        return self._other.get(student_id)
+
+    def add(self, student_id: int, status: str) -> None:
+        if self.get(student_id) is not None:
+            return
+        if status == "present":
+            self._present.add(student_id)
+        elif status == "late":
+            self._late.add(student_id)
+        else:
+            self._other[student_id] = status
+
+    @property
+    def count(self) -> int:
+        return len(self._present) + len(self._late) + len(self._other)
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self._present) + sys.getsizeof(self._late) + sys.getsizeof(self._other)
+
+
+class AttendanceMarks:
+    """Per-(session, course) marks for the most recent sessions (LRU).
+
+    Only sessions this process has validated get an entry, so an id found
+    here needs no further session check. Marks only ever grow: the upsert
+    is first-check-in-wins, so a student once marked stays marked with the
+    original status. Rows edited or deleted outside the API are announced
+    by migrations/0006_attendance_notify.sql and drop the session's entry.
+    """
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._items: "OrderedDict[Tuple[int, int], SessionMarks]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.repeats = 0
+
+    def split(self, key: Tuple[int, int], student_ids: Iterable[int]) -> Tuple[List[int], Dict[int, str]]:
+        """(ids not marked yet, {id: original status} for ids already marked)."""
+        new, seen = [], {}
+        with self._lock:
+            m = self._items.get(key)
+            if m is not None:
+                self._items.move_to_end(key)
+            for sid in student_ids:
+                status = m.get(sid) if m is not None else None
+                if status is None:
+                    new.append(sid)
+                else:
+                    seen[sid] = status
+            self.repeats += len(seen)
+        return new, seen
+
+    def add(self, key: Tuple[int, int], statuses: Dict[int, str]) -> None:
+        with self._lock:
+            m = self._items.get(key)
+            if m is None:
+                m = self._items[key] = SessionMarks()
+                while len(self._items) > self.max_sessions:
+                    self._items.popitem(last=False)
+            self._items.move_to_end(key)
+            for sid, status in statuses.items():
+                m.add(int(sid), status)
+
+    def invalidate(self, session_id: int) -> None:
+        with self._lock:
+            for key in [k for k in self._items if k[0] == session_id]:
+                del self._items[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._items),
+                "marked": sum(m.count for m in self._items.values()),
+                "bytes": sum(m.nbytes for m in self._items.values()),
+                "repeats": self.repeats,
+            }
+
+
+marks = AttendanceMarks(int(os.getenv("ATTENDANCE_STATE_SESSIONS", "512")))
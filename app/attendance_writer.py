@@ -0,0 +1,274 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import psycopg
+
+from app.db import db
+
+# Optional write-behind for attendance: a check-in is appended to a local
+# journal (fsync'd) and acknowledged; a background thread upserts the
+# buffered rows in one statement every ATTENDANCE_FLUSH_MS or
+# ATTENDANCE_FLUSH_ROWS rows. Journals left by a crashed process are
+# replayed at startup. Rows the DB rejects (e.g. a session deleted since
+# the check-in) are isolated by splitting the batch and appended to
+# dead-letter.log in the journal directory instead of blocking the queue.
+ATTENDANCE_WRITE_BEHIND = os.getenv("ATTENDANCE_WRITE_BEHIND", "0") == "1"
+ATTENDANCE_FLUSH_MS = float(os.getenv("ATTENDANCE_FLUSH_MS", "50"))
+ATTENDANCE_FLUSH_ROWS = int(os.getenv("ATTENDANCE_FLUSH_ROWS", "500"))
+ATTENDANCE_JOURNAL_DIR = os.getenv("ATTENDANCE_JOURNAL_DIR", "data/journal")
+
+Row = Tuple[int, int, str, str]  # session_id, student_id, status, ISO timestamp
+
+
+def upsert_attendance(cur, rows: List[Row]) -> None:
+    # one multi-row insert; the first check-in per (session, student) wins,
+    # both within the batch and against rows already in the DB, so replaying
+    # a journal is harmless
+    first = {}
+    for row in rows:
+        first.setdefault((row[0], row[1]), row)
+    rows = list(first.values())
+    cur.execute(
+        """
+        INSERT INTO public.attendance (session_id, student_id, status, timestamp)
+        SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::text[], %s::timestamptz[])
+        ON CONFLICT (session_id, student_id) DO NOTHING
+        """,
+        ([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], [r[3] for r in rows]),
+        prepare=True,
+    )
+
+
+class AttendanceWriter:
+    """Journal + in-memory buffer + flusher thread for one process.
+
+    Every process owns ``attendance-<pid>.log`` and holds an flock on it, so
+    at startup any journal whose lock can be taken belongs to a dead process
+    and is replayed. Concurrent submitters share fsyncs (group commit). The
+    journal is truncated whenever everything written to it has been flushed.
+    A batch the DB rejects is halved until the offending rows are alone;
+    those go to the dead-letter file.
+    """
+
+    def __init__(self, root: str = ATTENDANCE_JOURNAL_DIR, flush_ms: float = ATTENDANCE_FLUSH_MS,
+                 flush_rows: int = ATTENDANCE_FLUSH_ROWS):
+        self.root = root
+        self.flush_s = flush_ms / 1000.0
+        self.flush_rows = flush_rows
+        self._buffer: List[Row] = []
+        self._cond = threading.Condition()
+        self._sync_lock = threading.Lock()
+        self._journal = None
+        self._written = 0  # rows appended to the journal
+        self._synced = 0   # rows known to be on disk
+        self._flushed = 0  # rows written to the DB
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.replayed = 0
+        self.dead_lettered = 0
+        self.last_error: Optional[str] = None
+
+    # ---- lifecycle ----
+    def start(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, f"attendance-{os.getpid()}.log")
+        while True:
+            self._journal = open(path, "a+b")
+            fcntl.flock(self._journal, fcntl.LOCK_EX)
+            # another process starting up may have taken the lock between our
+            # open and flock, replayed the file and unlinked it; only a lock
+            # on the file still at the path counts
+            if _still_at(path, self._journal):
+                break
+            self._journal.close()
+        self._replay_orphans()
+        self._thread = threading.Thread(target=self._run, name="attendance-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10.0)
+            self._thread = None
+
+    # ---- hot path ----
+    def submit(self, session_id: int, student_ids: List[int], status: str) -> None:
+        """Journal the check-ins durably and queue them for the DB."""
+        ts = datetime.now(timezone.utc).isoformat()
+        rows = [(session_id, int(sid), status, ts) for sid in student_ids]
+        data = b"".join(json.dumps(r).encode() + b"\n" for r in rows)
+        with self._cond:
+            self._journal.write(data)
+            self._written += len(rows)
+            seq = self._written
+            self._buffer.extend(rows)
+            if len(self._buffer) >= self.flush_rows:
+                self._cond.notify()
+        self._sync(seq)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": len(self._buffer),
+                "journaled": self._written,
+                "flushed": self._flushed,
+                "flushes": self.flushes,
+                "replayed": self.replayed,
+                "dead_lettered": self.dead_lettered,
+                "last_error": self.last_error,
+            }
+
+    # ---- internals ----
+    def _sync(self, seq: int) -> None:
+        # whoever gets the lock fsyncs everything written so far; the others
+        # find their rows already covered
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            with self._cond:
+                upto = self._written
+                self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._synced = upto
+
+    def _replay_orphans(self) -> None:
+        # our own file may be left over from an earlier process with the same
+        # pid (pid 1 in a container); its rows are already journaled
+        self._journal.seek(0)
+        rows, size = _read_rows(self._journal)
+        self._journal.truncate(size)
+        self._written = len(rows)
+        self._buffer.extend(rows)
+        self.replayed += len(rows)
+
+        # workers starting together race for the same orphans: one that is
+        # gone, or was replaced, by the time we hold its lock is skipped
+        for path in sorted(glob.glob(os.path.join(self.root, "attendance-*.log"))):
+            try:
+                if os.path.samefile(path, self._journal.name):
+                    continue
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # a live process owns it
+                if not _still_at(path, f):
+                    continue
+                rows, _ = _read_rows(f)
+                if rows:
+                    # re-journal under our own file before dropping the old one
+                    with self._cond:
+                        self._journal.write(b"".join(json.dumps(r).encode() + b"\n" for r in rows))
+                        self._written += len(rows)
+                        self._buffer.extend(rows)
+                    self._sync(self._written)
+                    self.replayed += len(rows)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def _run(self) -> None:
+        backoff = self.flush_s
+        while True:
+            with self._cond:
+                if len(self._buffer) < self.flush_rows and not self._stop:
+                    # let a burst accumulate for up to one flush interval
+                    self._cond.wait(timeout=self.flush_s)
+                batch, self._buffer = self._buffer, []
+                stopping = self._stop
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    self.last_error = str(e)
+                    if stopping:
+                        return  # rows stay in the journal for the next start
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 5.0)
+                    continue
+                backoff = self.flush_s
+                with self._cond:
+                    self.flushes += 1
+                    self._truncate_if_drained()
+            if stopping and not batch:
+                return
+
+    def _write(self, batch: List[Row]) -> None:
+        # upsert the batch; a part the DB rejects row by row (constraint or
+        # data errors) is halved until single rows fail, and those are
+        # dead-lettered. Any other error puts the unwritten rows back in
+        # front of the buffer and is raised for the caller to back off.
+        parts = [batch]
+        while parts:
+            part = parts.pop()
+            try:
+                with db() as conn, conn.cursor() as cur:
+                    upsert_attendance(cur, part)
+            except (psycopg.IntegrityError, psycopg.DataError) as e:
+                self.last_error = str(e)
+                if len(part) > 1:
+                    mid = len(part) // 2
+                    parts.extend((part[mid:], part[:mid]))
+                    continue
+                self._dead_letter(part)
+            except Exception:
+                with self._cond:
+                    self._buffer[:0] = part + [r for p in reversed(parts) for r in p]
+                raise
+            with self._cond:
+                self._flushed += len(part)
+
+    def _dead_letter(self, rows: List[Row]) -> None:
+        with open(os.path.join(self.root, "dead-letter.log"), "ab") as f:
+            f.write(b"".join(json.dumps(r).encode() + b"\n" for r in rows))
+            f.flush()
+            os.fsync(f.fileno())
+        self.dead_lettered += len(rows)
+
+    def _truncate_if_drained(self) -> None:
+        # caller holds self._cond; nothing journaled is still pending
+        if self._buffer or self._flushed < self._written:
+            return
+        # not fsync'd: if the truncation is lost, replaying rows that are
+        # already in the DB is harmless
+        self._journal.flush()
+        self._journal.truncate(0)
+
+
+def _still_at(path: str, f) -> bool:
+    # is the open file ``f`` still the one named ``path``?
+    try:
+        return os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _read_rows(f) -> Tuple[List[Row], int]:
+    # complete journal lines and their byte length; a torn last line from a
+    # crashed write ends the journal
+    rows, size = [], 0
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        try:
+            rows.append(tuple(json.loads(line)))
+        except ValueError:
+            break
+        size += len(line)
+    return rows, size
+
+
+writer = AttendanceWriter() if ATTENDANCE_WRITE_BEHIND else None
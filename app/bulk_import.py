@@ -0,0 +1,210 @@
+import asyncio
+import os
+from typing import AsyncIterator, List, Optional, Tuple
+
+import numpy as np
+import orjson
+
+from app.embeddings import MIN_WIRE_DIMS, STORAGE_DTYPE, embedding_from_list, pack_embedding
+from app.executors import run_matching
+from app.matching import EMBEDDING_DIM, normalize_rows
+
+# Bulk enrollment: a stream of (student_id, descriptor) records, either
+# NDJSON ({"student_id": 1, "embedding": [...]} per line) or fixed-size
+# binary records (int64 LE student id + the descriptor as packed float32
+# LE, X-Embedding-Dim values, 128 by default). Records are parsed while the
+# body arrives and loaded BULK_CHUNK_ROWS at a time: COPY into a temp
+# staging table, then one statement checks roles and upserts the chunk.
+# The next chunk is only read once the previous one is merged, so a client
+# can't push faster than the DB takes it; BULK_MAX_CONCURRENT imports run
+# at once, later ones wait with their upload unread.
+BULK_CHUNK_ROWS = int(os.getenv("BULK_CHUNK_ROWS", "5000"))
+BULK_MAX_CONCURRENT = int(os.getenv("BULK_MAX_CONCURRENT", "2"))
+BULK_MAX_LINE_BYTES = 1024 * 1024
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+BINARY_CONTENT_TYPE = "application/octet-stream"
+
+slots = asyncio.Semaphore(BULK_MAX_CONCURRENT)
+
+
+class Chunk:
+    """Valid records of one chunk: 1-based record numbers (ascending),
+    student ids, unit rows and original norms."""
+
+    __slots__ = ("records", "ids", "units", "norms")
+
+    def __init__(self, records: np.ndarray, ids: np.ndarray, units: np.ndarray, norms: np.ndarray):
+        self.records = records
+        self.ids = ids
+        self.units = units
+        self.norms = norms
+
+    def __len__(self) -> int:
+        return self.records.shape[0]
+
+
+async def read_chunks(stream: AsyncIterator[bytes], content_type: str,
+                      declared_dim: Optional[str] = None) -> AsyncIterator[Tuple[Chunk, List[dict]]]:
+    """Yield (chunk, per-record errors) while reading ``stream``.
+
+    Raises ValueError for problems that make the rest of the body
+    unreadable (unknown content type, bad dimension, oversized line).
+    Parsing runs on the matching executor, off the event loop.
+    """
+    media = content_type.split(";", 1)[0].strip().lower()
+    if media in NDJSON_CONTENT_TYPES:
+        async for lines, first in _split_lines(stream):
+            yield await run_matching(_parse_lines, lines, first)
+    elif media == BINARY_CONTENT_TYPE:
+        dim = _record_dim(declared_dim)
+        rec = np.dtype([("student_id", "<i8"), ("embedding", STORAGE_DTYPE, (dim,))])
+        buf, first = bytearray(), 1
+        async for data in stream:
+            buf += data
+            n = min(len(buf) // rec.itemsize, BULK_CHUNK_ROWS)
+            while n == BULK_CHUNK_ROWS:
+                yield await run_matching(_parse_records, bytes(buf[: n * rec.itemsize]), rec, first)
+                del buf[: n * rec.itemsize]
+                first += n
+                n = min(len(buf) // rec.itemsize, BULK_CHUNK_ROWS)
+        n = len(buf) // rec.itemsize
+        chunk, errors = await run_matching(_parse_records, bytes(buf[: n * rec.itemsize]), rec, first)
+        if len(buf) % rec.itemsize:
+            errors.append({"record": first + n, "detail": "Truncated record"})
+        yield chunk, errors
+    else:
+        raise ValueError(f"Send {NDJSON_CONTENT_TYPES[0]} or {BINARY_CONTENT_TYPE}")
+
+
+def _record_dim(declared_dim: Optional[str]) -> int:
+    try:
+        dim = int(declared_dim) if declared_dim is not None else EMBEDDING_DIM
+    except ValueError:
+        dim = 0
+    if not MIN_WIRE_DIMS <= dim <= 4 * EMBEDDING_DIM:
+        raise ValueError("Invalid X-Embedding-Dim")
+    return dim
+
+
+async def _split_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[Tuple[List[bytes], int]]:
+    # (lines, record number of the first line) per BULK_CHUNK_ROWS lines;
+    # blank lines count as records so numbers match the client's line numbers
+    tail, lines, first = b"", [], 1
+    async for data in stream:
+        parts = (tail + data).split(b"\n")
+        tail = parts.pop()
+        if len(tail) > BULK_MAX_LINE_BYTES:
+            raise ValueError(f"Record {first + len(lines) + len(parts)} is longer than {BULK_MAX_LINE_BYTES} bytes")
+        lines.extend(parts)
+        while len(lines) >= BULK_CHUNK_ROWS:
+            yield lines[:BULK_CHUNK_ROWS], first
+            del lines[:BULK_CHUNK_ROWS]
+            first += BULK_CHUNK_ROWS
+    if tail.strip():
+        lines.append(tail)
+    yield lines, first
+
+
+def _parse_lines(lines: List[bytes], first: int) -> Tuple[Chunk, List[dict]]:
+    records, ids, vecs, errors = [], [], [], []
+    for no, line in enumerate(lines, first):
+        if not line.strip():
+            continue
+        sid = None
+        try:
+            doc = orjson.loads(line)
+            if not isinstance(doc, dict):
+                raise ValueError('Record must be {"student_id": id, "embedding": [numbers]}')
+            sid = doc.get("student_id")
+            if not isinstance(sid, int) or isinstance(sid, bool):
+                sid = None
+                raise ValueError("Invalid student_id")
+            emb = doc.get("embedding")
+            if not isinstance(emb, list):
+                raise ValueError("Embedding must be a list of numbers")
+            vecs.append(embedding_from_list(emb))
+        except orjson.JSONDecodeError:
+            errors.append({"record": no, "detail": "Invalid JSON"})
+            continue
+        except ValueError as e:
+            errors.append({"record": no, "student_id": sid, "detail": str(e)})
+            continue
+        records.append(no)
+        ids.append(sid)
+    matrix = np.zeros((len(vecs), EMBEDDING_DIM), dtype=np.float32)
+    for i, v in enumerate(vecs):
+        matrix[i, : v.shape[0]] = v
+    return _chunk(np.array(records, dtype=np.int64), np.array(ids, dtype=np.int64), matrix, errors)
+
+
+def _parse_records(data: bytes, rec: np.dtype, first: int) -> Tuple[Chunk, List[dict]]:
+    arr = np.frombuffer(data, dtype=rec)
+    emb = arr["embedding"][:, :EMBEDDING_DIM]
+    matrix = np.zeros((arr.shape[0], EMBEDDING_DIM), dtype=np.float32)
+    matrix[:, : emb.shape[1]] = emb
+    records = np.arange(first, first + arr.shape[0], dtype=np.int64)
+    ok = np.isfinite(matrix).all(axis=1)
+    errors = [{"record": int(records[i]), "student_id": int(arr["student_id"][i]),
+               "detail": "Invalid embedding (non-finite values)"} for i in np.flatnonzero(~ok)]
+    return _chunk(records[ok], arr["student_id"][ok].astype(np.int64), matrix[ok], errors)
+
+
+def _chunk(records: np.ndarray, ids: np.ndarray, matrix: np.ndarray, errors: List[dict]) -> Tuple[Chunk, List[dict]]:
+    units, norms = normalize_rows(matrix)
+    ok = norms > 0
+    errors.extend({"record": int(records[i]), "student_id": int(ids[i]),
+                   "detail": "Invalid embedding (zero vector)"} for i in np.flatnonzero(~ok))
+    errors.sort(key=lambda e: e["record"])
+    return Chunk(records[ok], ids[ok], units[ok], norms[ok]), errors
+
+
+# ---- DB side ----
+_STAGE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS bulk_embeddings (
+        record bigint, student_id bigint, embedding_vec bytea, embedding_norm real
+    ) ON COMMIT DELETE ROWS
+"""
+
+# the last record per student wins; only users with role 'student' are
+# stored; every distinct student comes back with its role (NULL: no such
+# user) and, if stored, its courses for the caches
+_MERGE_SQL = """
+    WITH staged AS (
+        SELECT DISTINCT ON (student_id) record, student_id, embedding_vec, embedding_norm
+        FROM bulk_embeddings
+        ORDER BY student_id, record DESC
+    ), checked AS (
+        SELECT s.*, u.role FROM staged s LEFT JOIN public.users u ON u.id = s.student_id
+    ), saved AS (
+        INSERT INTO public.student_embeddings
+            (student_id, embedding_vec, embedding_norm, embedding)
+        SELECT student_id, embedding_vec, embedding_norm, NULL FROM checked WHERE role = 'student'
+        ON CONFLICT (student_id)
+        DO UPDATE SET embedding_vec = EXCLUDED.embedding_vec,
+                      embedding_norm = EXCLUDED.embedding_norm,
+                      embedding = NULL,
+                      created_at = NOW()
+    )
+    SELECT c.record, c.student_id, c.role,
+           CASE WHEN c.role = 'student' THEN
+               ARRAY(SELECT e.course_id FROM public.enrollments e WHERE e.student_id = c.student_id)
+           END
+    FROM checked c
+    ORDER BY c.record
+"""
+
+
+async def merge_chunk(conn, chunk: Chunk) -> list:
+    """COPY one chunk into staging and merge it in the same transaction;
+    returns (record, student_id, role, course_ids) per distinct student."""
+    async with conn.transaction(), conn.cursor() as cur:
+        await cur.execute(_STAGE_SQL)
+        async with cur.copy(
+            "COPY bulk_embeddings (record, student_id, embedding_vec, embedding_norm) FROM STDIN (FORMAT BINARY)"
+        ) as copy:
+            copy.set_types(["int8", "int8", "bytea", "float4"])
+            for row in zip(chunk.records.tolist(), chunk.ids.tolist(),
+                           map(pack_embedding, chunk.units), chunk.norms.tolist()):
+                await copy.write_row(row)
+        await cur.execute(_MERGE_SQL)
+        return await cur.fetchall()
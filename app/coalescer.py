@@ -0,0 +1,114 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+# Concurrent check-ins for the same (course, session) are collected for up
+# to CHECKIN_COALESCE_MS and scored + written as one batch. A request that
+# arrives while nothing else for its key is in flight runs immediately, so
+# the window only ever applies under concurrency.
+CHECKIN_COALESCE_MS = float(os.getenv("CHECKIN_COALESCE_MS", "2"))
+CHECKIN_COALESCE_MAX = int(os.getenv("CHECKIN_COALESCE_MAX", "64"))
+
+
+class _Batch:
+    __slots__ = ("items", "full", "done", "results", "error")
+
+    def __init__(self, item):
+        self.items = [item]
+        self.full = asyncio.Event()
+        self.done = asyncio.Event()
+        self.results: Optional[List[Any]] = None
+        self.error: Optional[BaseException] = None
+
+
+class _KeyState:
+    __slots__ = ("inflight", "open")
+
+    def __init__(self):
+        self.inflight = 0
+        self.open: Optional[_Batch] = None
+
+
+class Coalescer:
+    """Leader/follower request batching on the event loop.
+
+    The first request of a batch is its leader: it waits up to the window
+    (or until the batch is full), runs ``run_batch`` on every collected item
+    and hands each follower its result. ``run_batch`` returns one result per
+    item; an exception instance in that list is raised in its caller only,
+    while an exception raised by ``run_batch`` itself fails the whole batch.
+    The batch runs as its own task, so a leader whose client goes away
+    doesn't strand the followers.
+    """
+
+    def __init__(self, window_ms: float = CHECKIN_COALESCE_MS, max_batch: int = CHECKIN_COALESCE_MAX):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._keys: Dict[Hashable, _KeyState] = {}
+        self.batches = 0
+        self.items = 0
+        self.max_seen = 0
+
+    async def submit(self, key: Hashable, item: Any,
+                     run_batch: Callable[[List[Any]], Awaitable[List[Any]]]) -> Any:
+        # no awaits until the batch is picked, so this needs no lock
+        st = self._keys.get(key)
+        if st is None:
+            st = self._keys[key] = _KeyState()
+        st.inflight += 1
+        batch = st.open
+        if batch is not None:
+            index, leader = len(batch.items), False
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                st.open = None
+                batch.full.set()
+        else:
+            batch, index, leader = _Batch(item), 0, True
+            if st.inflight > 1:
+                # others are busy with this key: collect followers
+                st.open = batch
+        try:
+            if leader:
+                await asyncio.shield(asyncio.ensure_future(self._lead(st, batch, run_batch)))
+            else:
+                await batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            result = batch.results[index]
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        finally:
+            st.inflight -= 1
+            if st.inflight == 0 and st.open is None and self._keys.get(key) is st:
+                del self._keys[key]
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window * 1000.0,
+            "batches": self.batches,
+            "items": self.items,
+            "max_batch_seen": self.max_seen,
+        }
+
+    async def _lead(self, st: _KeyState, batch: _Batch, run_batch) -> None:
+        if st.open is batch:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            if st.open is batch:
+                st.open = None
+        self.batches += 1
+        self.items += len(batch.items)
+        self.max_seen = max(self.max_seen, len(batch.items))
+        try:
+            batch.results = await run_batch(batch.items)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+
+coalescer = Coalescer() if CHECKIN_COALESCE_MS > 0 else None
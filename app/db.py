@@ -1,9 +1,127 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from app.core.config import settings
+import os
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator, Optional
 
-# DB_URL comes from Render environment variables
-DB_URL = settings.DB_URL
+import psycopg
+from fastapi import HTTPException
+from psycopg_pool import AsyncConnectionPool, ConnectionPool, PoolTimeout
 
-engine = create_engine(DB_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# One pooled psycopg layer for the whole app. Connections are opened (and
+# TLS-negotiated) once at startup and reused by every request.
+
+def _normalize_pg_url(url: str) -> str:
+    # Render sometimes gives postgres:// instead of postgresql://
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    # Ensure sslmode=require is always present
+    if "sslmode=" not in url:
+        sep = "&" if "?" in url else "?"
+        url = f"{url}{sep}sslmode=require"
+    return url
+
+def get_db_url() -> str:
+    url = os.getenv("DB_URL") or os.getenv("DATABASE_URL")
+    if not url:
+        raise HTTPException(
+            status_code=500,
+            detail="Missing DB_URL / DATABASE_URL environment variable"
+        )
+    return _normalize_pg_url(url)
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+_pool: Optional[ConnectionPool] = None
+_instance: Optional[str] = None
+
+def instance_name() -> str:
+    # application_name of this process's connections; shows up in
+    # pg_stat_activity and tags the origin of cache notifications
+    global _instance
+    if _instance is None or not _instance.endswith(f"-{os.getpid()}"):
+        _instance = f"face-attendance-{uuid.uuid4().hex[:8]}-{os.getpid()}"
+    return _instance
+
+def _pool_kwargs(prefix: str, min_size: int, max_size: int) -> dict:
+    return dict(
+        min_size=_env_int(f"{prefix}_MIN_SIZE", min_size),
+        max_size=_env_int(f"{prefix}_MAX_SIZE", max_size),
+        timeout=_env_float("DB_POOL_TIMEOUT", 10.0),
+        max_idle=_env_float("DB_POOL_MAX_IDLE", 300.0),
+        max_lifetime=_env_float("DB_POOL_MAX_LIFETIME", 3600.0),
+        kwargs={"autocommit": True, "application_name": instance_name()},
+    )
+
+def open_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(
+            get_db_url(),
+            **_pool_kwargs("DB_POOL", 2, 10),
+            name="face-attendance",
+            open=False,
+        )
+        # don't block startup on a slow/remote DB; connections fill in the background
+        _pool.open(wait=False)
+    return _pool
+
+def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+@contextmanager
+def db() -> Iterator[psycopg.Connection]:
+    # borrow a pooled connection; opens the pool lazily for scripts/tests
+    pool = _pool or open_pool()
+    try:
+        with pool.connection() as conn:
+            yield conn
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, try again")
+
+def pool_stats() -> dict:
+    if _pool is None:
+        return {"open": False}
+    return {"open": True, **_pool.get_stats()}
+
+# ---- async pool: for the async hot-path endpoints (checkin-vec,
+# save_embedding), so requests waiting on a slow DB hold no thread ----
+_apool: Optional[AsyncConnectionPool] = None
+
+async def open_async_pool() -> AsyncConnectionPool:
+    global _apool
+    if _apool is None:
+        _apool = AsyncConnectionPool(
+            get_db_url(),
+            **_pool_kwargs("DB_ASYNC_POOL", 2, 20),
+            name="face-attendance-async",
+            open=False,
+        )
+        await _apool.open(wait=False)
+    return _apool
+
+async def close_async_pool() -> None:
+    global _apool
+    if _apool is not None:
+        await _apool.close()
+        _apool = None
+
+@asynccontextmanager
+async def adb() -> AsyncIterator[psycopg.AsyncConnection]:
+    pool = _apool or await open_async_pool()
+    try:
+        async with pool.connection() as conn:
+            yield conn
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, try again")
+
+def async_pool_stats() -> dict:
+    if _apool is None:
+        return {"open": False}
+    return {"open": True, **_apool.get_stats()}
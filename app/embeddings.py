@@ -0,0 +1,127 @@
+import base64
+import binascii
+import json
+from typing import Optional, Sequence
+
+import numpy as np
+import orjson
+
+from app.matching import EMBEDDING_DIM, normalize_rows
+
+# Stored embeddings: packed little-endian float32, EMBEDDING_DIM values,
+# L2-normalized, with the original norm in embedding_norm.
+STORAGE_DTYPE = np.dtype("<f4")
+
+
+def pack_embedding(emb: Sequence[float]) -> bytes:
+    return np.asarray(emb, dtype=STORAGE_DTYPE).tobytes()
+
+
+def unpack_embedding(buf: bytes) -> np.ndarray:
+    return np.frombuffer(buf, dtype=STORAGE_DTYPE)
+
+
+# Live embeddings on the wire (check-in and enrollment bodies). Besides the
+# JSON {"embedding": [...]} body, clients can send the descriptor as packed
+# little-endian float32, either raw (application/octet-stream) or base64
+# encoded (text/plain), optionally declaring the count in X-Embedding-Dim.
+# At least MIN_WIRE_DIMS values; anything past EMBEDDING_DIM is ignored.
+MIN_WIRE_DIMS = 64
+BINARY_CONTENT_TYPE = "application/octet-stream"
+BASE64_CONTENT_TYPE = "text/plain"
+
+
+def parse_embedding(body: bytes, content_type: str, declared_dim: Optional[str] = None) -> np.ndarray:
+    """Decode a live embedding body into float32 (a view of ``body`` for the
+    binary formats). Raises ValueError with a client-facing message."""
+    media = content_type.split(";", 1)[0].strip().lower()
+    if media in (BINARY_CONTENT_TYPE, BASE64_CONTENT_TYPE):
+        if media == BASE64_CONTENT_TYPE:
+            try:
+                body = base64.b64decode(body, validate=True)
+            except (binascii.Error, ValueError):
+                raise ValueError("Invalid base64 embedding")
+        if len(body) % STORAGE_DTYPE.itemsize:
+            raise ValueError("Invalid embedding length")
+        vec = np.frombuffer(body, dtype=STORAGE_DTYPE)
+        if declared_dim is not None and declared_dim.strip() != str(vec.shape[0]):
+            raise ValueError("Embedding length does not match X-Embedding-Dim")
+        return check_embedding(vec)
+    try:
+        doc = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise ValueError("Invalid JSON body")
+    emb = doc.get("embedding") if isinstance(doc, dict) else None
+    if not isinstance(emb, list):
+        raise ValueError('Body must be {"embedding": [numbers]}')
+    return embedding_from_list(emb)
+
+
+def embedding_from_list(emb: list) -> np.ndarray:
+    # decoded JSON array -> float32, numbers only
+    vec = np.array(emb[:EMBEDDING_DIM])
+    if vec.ndim != 1 or vec.dtype.kind not in "iuf":
+        raise ValueError("Embedding must be a list of numbers")
+    return check_embedding(vec, len(emb))
+
+
+def check_embedding(vec: np.ndarray, n: Optional[int] = None) -> np.ndarray:
+    # n: length as sent, when vec was already cut to EMBEDDING_DIM
+    if (vec.shape[0] if n is None else n) < MIN_WIRE_DIMS:
+        raise ValueError("Invalid embedding length")
+    vec = vec[:EMBEDDING_DIM].astype(np.float32, copy=False)
+    if not np.isfinite(vec).all():
+        raise ValueError("Invalid embedding (non-finite values)")
+    return vec
+
+
+def decode_stored(vec: Optional[bytes], legacy) -> Optional[np.ndarray]:
+    # dual-read: prefer the bytea column, fall back to the old JSONB value
+    if vec is not None:
+        return unpack_embedding(vec)
+    if isinstance(legacy, str):
+        try:
+            legacy = json.loads(legacy)
+        except Exception:
+            return None
+    if legacy is None:
+        return None
+    return np.asarray(legacy, dtype=np.float32)
+
+
+def stack_stored(rows, dim: int = EMBEDDING_DIM):
+    """Turn (student_id, embedding_vec, embedding_norm, embedding_jsonb) rows
+    into (ids, unit matrix, norms).
+
+    When every row is already binary, full width and normalized, the blobs
+    are joined and viewed as one (n, dim) float32 buffer without touching
+    Python floats. Older rows (JSONB, or bytea without a norm) are
+    normalized here.
+    """
+    n = len(rows)
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    width = dim * STORAGE_DTYPE.itemsize
+    if all(r[1] is not None and r[2] is not None and len(r[1]) == width for r in rows):
+        buf = b"".join(r[1] for r in rows)
+        matrix = np.frombuffer(buf, dtype=STORAGE_DTYPE).reshape(n, dim)
+        norms = np.fromiter((r[2] for r in rows), dtype=np.float32, count=n)
+        return ids, matrix.astype(np.float32, copy=False), norms
+
+    keep = np.ones(n, dtype=bool)
+    matrix = np.zeros((n, dim), dtype=np.float32)
+    norms = np.zeros(n, dtype=np.float32)
+    raw = np.zeros(n, dtype=bool)
+    for i, (_, vec, norm, legacy) in enumerate(rows):
+        v = decode_stored(vec, legacy)
+        if v is None:
+            keep[i] = False
+            continue
+        v = v[:dim]
+        matrix[i, : v.shape[0]] = v
+        if vec is not None and norm is not None:
+            norms[i] = norm
+        else:
+            raw[i] = True
+    if raw.any():
+        matrix[raw], norms[raw] = normalize_rows(matrix[raw])
+    return ids[keep], matrix[keep], norms[keep]
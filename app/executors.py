@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence
+
+from app.matching import Gallery, Match
+from app.shared_gallery import map_gallery_file
+
+# Separate pools so one kind of work can't starve the other: CPU-bound
+# matching (GEMMs, gallery patches) and blocking DB calls made from async
+# endpoints each get their own bounded executor instead of sharing the
+# event loop or FastAPI's request threadpool. NumPy/BLAS release the GIL,
+# so a few matching threads keep the cores busy.
+MATCH_WORKERS = int(os.getenv("MATCH_WORKERS", str(min(4, os.cpu_count() or 1))))
+DB_WORKERS = int(os.getenv("DB_WORKERS", "16"))
+# optional worker processes for brute-force scans of very large galleries;
+# they map the shared gallery file themselves, so only galleries published
+# through SHARED_GALLERIES are eligible (0 = off)
+MATCH_PROCESSES = int(os.getenv("MATCH_PROCESSES", "0"))
+MATCH_PROCESS_MIN_ROWS = int(os.getenv("MATCH_PROCESS_MIN_ROWS", "200000"))
+
+
+def _timed(fn: Callable[..., Any], *args: Any):
+    # runs in the worker; CLOCK_MONOTONIC is shared by every process on the
+    # host, so the start time is comparable with the submitter's
+    return time.monotonic(), fn(*args)
+
+
+class MeteredExecutor:
+    """A lazily started executor plus queue-depth and wait-time counters.
+
+    Counters are only touched on the event loop. A task is queued while more
+    tasks are in flight than there are workers; its wait is the time from
+    submission until a worker picked it up.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Executor], workers: int):
+        self.name = name
+        self._factory = factory
+        self._executor: Optional[Executor] = None
+        self.workers = workers
+        self.inflight = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_s = 0.0
+        self.max_wait_s = 0.0
+        self.run_s = 0.0
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.inflight - self.workers)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = self._factory()
+        self.inflight += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        submitted = time.monotonic()
+        try:
+            started, result = await loop.run_in_executor(self._executor, functools.partial(_timed, fn, *args))
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.inflight -= 1
+        wait = max(0.0, started - submitted)
+        self.completed += 1
+        self.wait_s += wait
+        self.max_wait_s = max(self.max_wait_s, wait)
+        self.run_s += time.monotonic() - started
+        return result
+
+    def stats(self) -> dict:
+        done = max(self.completed, 1)
+        return {
+            "workers": self.workers,
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_ms": round(self.wait_s / done * 1000.0, 3),
+            "max_wait_ms": round(self.max_wait_s * 1000.0, 3),
+            "avg_run_ms": round(self.run_s / done * 1000.0, 3),
+        }
+
+    def shutdown(self) -> None:
+        # started again on next use
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+matching = MeteredExecutor(
+    "matching", lambda: ThreadPoolExecutor(MATCH_WORKERS, thread_name_prefix="match"), MATCH_WORKERS)
+db_io = MeteredExecutor(
+    "db", lambda: ThreadPoolExecutor(DB_WORKERS, thread_name_prefix="db"), DB_WORKERS)
+# spawn, not fork: the parent has pool, listener and writer threads running
+match_processes = MeteredExecutor(
+    "match_processes",
+    lambda: ProcessPoolExecutor(MATCH_PROCESSES, mp_context=multiprocessing.get_context("spawn")),
+    MATCH_PROCESSES,
+) if MATCH_PROCESSES > 0 else None
+
+
+async def run_matching(fn: Callable[..., Any], *args: Any) -> Any:
+    return await matching.run(fn, *args)
+
+
+async def run_db(fn: Callable[..., Any], *args: Any) -> Any:
+    return await db_io.run(fn, *args)
+
+
+async def match_gallery(gallery: Gallery, lives: Sequence[Sequence[float]]) -> List[Optional[Match]]:
+    """Best match per live vector, on the executor that fits the gallery.
+
+    Brute-force scans of very large shared galleries go to the process pool
+    (when enabled); everything else, including HNSW-indexed lookups, runs on
+    the matching threads.
+    """
+    indexed = gallery.index is not None and gallery.index.ready
+    if (match_processes is not None and gallery.source is not None
+            and len(gallery) >= MATCH_PROCESS_MIN_ROWS and not indexed):
+        try:
+            return await match_processes.run(_match_mapped, *gallery.source, list(lives))
+        except FileNotFoundError:
+            pass  # republished meanwhile; the mapping we hold still works here
+    if len(lives) == 1:
+        return [await matching.run(gallery.best_match, lives[0])]
+    return await matching.run(gallery.match_many, lives)
+
+
+def stats() -> dict:
+    return {
+        "matching": matching.stats(),
+        "db": db_io.stats(),
+        "match_processes": match_processes.stats() if match_processes is not None else None,
+    }
+
+
+def shutdown() -> None:
+    for ex in (matching, db_io, match_processes):
+        if ex is not None:
+            ex.shutdown()
+
+
+# ---- process pool side: galleries mapped by each worker process ----
+_mapped: "OrderedDict[str, Gallery]" = OrderedDict()
+_MAPPED_MAX = 8
+
+
+def _match_mapped(path: str, meta: dict, lives: List[Sequence[float]]) -> List[Optional[Match]]:
+    g = _mapped.get(path)
+    if g is None:
+        g = _mapped[path] = map_gallery_file(path, meta)
+        while len(_mapped) > _MAPPED_MAX:
+            _mapped.popitem(last=False)
+    _mapped.move_to_end(path)
+    if len(lives) == 1:
+        return [g.best_match(lives[0])]
+    return g.match_many(lives)
@@ -0,0 +1,115 @@
+import os
+import struct
+from typing import AsyncIterator, Optional, Tuple
+
+import numpy as np
+
+from app.db import adb
+from app.embeddings import STORAGE_DTYPE, stack_stored
+from app.executors import run_matching
+from app.matching import EMBEDDING_DIM
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow export is optional
+    pa = None
+
+# Streaming export of public.student_embeddings for analytics and offline
+# matching. Rows are read in student_id order through a server-side cursor,
+# EXPORT_BATCH_ROWS at a time, and each batch is encoded and sent before the
+# next is fetched, so memory stays flat whatever the table size. A cut-off
+# export resumes with after=<last student_id received>; until= bounds a
+# range so several clients can split the id space.
+#
+# "binary": a 16-byte header (magic, dim, 4 reserved bytes), then blocks of
+#   uint32 n | n int64 student ids | n float32 norms | n*dim float32 unit rows
+# all little-endian, ids ascending, ended by a block with n = 0 (a stream
+# without it was cut off).
+# "arrow": an Arrow IPC stream (student_id int64, norm float32, embedding
+# fixed_size_list<float32>[dim]), one record batch per block.
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "10000"))
+FORMATS = ("binary", "arrow")
+MEDIA_TYPES = {"binary": "application/octet-stream", "arrow": "application/vnd.apache.arrow.stream"}
+MAGIC = b"FAEMBED1"
+_HEADER = struct.Struct("<8sI4x")
+_BLOCK = struct.Struct("<I")
+# end-of-stream marker of the Arrow IPC stream format
+_ARROW_EOS = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+_EXPORT_SQL = """
+    SELECT student_id, embedding_vec, embedding_norm,
+           CASE WHEN embedding_vec IS NULL THEN embedding END
+    FROM public.student_embeddings
+    WHERE (%(after)s::bigint IS NULL OR student_id > %(after)s)
+      AND (%(until)s::bigint IS NULL OR student_id <= %(until)s)
+      AND (%(since)s::bigint IS NULL OR version >= %(since)s)
+    ORDER BY student_id
+    LIMIT %(limit)s
+"""
+
+
+async def open_export(fmt: str, after: Optional[int] = None, until: Optional[int] = None,
+                      since: Optional[int] = None, limit: Optional[int] = None) -> Tuple[int, AsyncIterator[bytes]]:
+    """Start an export; returns (version stamp, body chunks).
+
+    Rows written from the stamp on carry student_embeddings.version >= it,
+    so since=<stamp> on a later export picks up what changed (deletions are
+    not reported). The body holds a pooled connection and an open
+    transaction until it is exhausted or closed.
+    """
+    body = _export(fmt, {"after": after, "until": until, "since": since, "limit": limit})
+    stamp = await body.__anext__()
+    return stamp, body
+
+
+async def _export(fmt: str, params: dict):
+    # first item: the stamp, taken before the cursor opens; then the body
+    async with adb() as conn, conn.transaction():
+        cur = await conn.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+        yield (await cur.fetchone())[0]
+        yield _start(fmt)
+        async with conn.cursor(name="embedding_export", binary=True) as cur:
+            await cur.execute(_EXPORT_SQL, params)
+            while True:
+                rows = await cur.fetchmany(EXPORT_BATCH_ROWS)
+                if not rows:
+                    break
+                yield await run_matching(_encode_rows, fmt, rows)
+        yield _end(fmt)
+
+
+def _start(fmt: str) -> bytes:
+    if fmt == "arrow":
+        return _arrow_schema().serialize().to_pybytes()
+    return _HEADER.pack(MAGIC, EMBEDDING_DIM)
+
+
+def _end(fmt: str) -> bytes:
+    return _ARROW_EOS if fmt == "arrow" else _BLOCK.pack(0)
+
+
+def _encode_rows(fmt: str, rows: list) -> bytes:
+    ids, units, norms = stack_stored(rows)
+    return _encode(fmt, ids, units, norms) if len(ids) else b""
+
+
+def _encode(fmt: str, ids: np.ndarray, units: np.ndarray, norms: np.ndarray) -> bytes:
+    if fmt == "arrow":
+        matrix = pa.FixedSizeListArray.from_arrays(pa.array(units.reshape(-1), pa.float32()), EMBEDDING_DIM)
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(ids, pa.int64()), pa.array(norms, pa.float32()), matrix], schema=_arrow_schema())
+        return batch.serialize().to_pybytes()
+    return b"".join((
+        _BLOCK.pack(len(ids)),
+        ids.astype("<i8", copy=False).tobytes(),
+        norms.astype(STORAGE_DTYPE, copy=False).tobytes(),
+        units.astype(STORAGE_DTYPE, copy=False).tobytes(),
+    ))
+
+
+def _arrow_schema() -> "pa.Schema":
+    return pa.schema([
+        ("student_id", pa.int64()),
+        ("norm", pa.float32()),
+        ("embedding", pa.list_(pa.float32(), EMBEDDING_DIM)),
+    ])
@@ -0,0 +1,231 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from app.matching import Gallery
+
+
+def _budget_from_env() -> int:
+    return int(float(os.getenv("GALLERY_CACHE_MB", "256")) * 1024 * 1024)
+
+
+class GalleryCache:
+    """Per-course galleries kept in process, evicted LRU under a byte budget.
+
+    Galleries are immutable; updates swap in a patched version, so a
+    check-in that already grabbed a gallery keeps scoring a consistent
+    snapshot.
+
+    The campus-wide gallery (every stored embedding, for identification
+    without a course) lives in its own slot outside the LRU, guarded by its
+    own lock: it is large, may carry an ANN index that is slow to rebuild,
+    and must not be evicted by a burst of course loads.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = _budget_from_env() if max_bytes is None else max_bytes
+        self._items: "OrderedDict[int, Gallery]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # one loader per course at a time, so a cold course under load
+        # triggers a single DB fetch instead of one per request
+        self._load_locks: Dict[int, threading.Lock] = {}
+        # bumped by every change to a course (patch, removal, invalidation),
+        # cached or not, so a load that raced a save is never cached; the
+        # epoch covers changes that hit every course at once
+        self._gens: Dict[int, int] = {}
+        self._epoch = 0
+        self._global: Optional[Gallery] = None
+        self._global_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_loads = 0
+
+    def get(self, course_id: int, loader: Callable[[int], Gallery]) -> Gallery:
+        g = self.peek(course_id)
+        if g is not None:
+            return g
+        with self._lock:
+            load_lock = self._load_locks.setdefault(course_id, threading.Lock())
+        with load_lock:
+            g = self.peek(course_id, count=False)
+            if g is not None:
+                return g
+            with self._lock:
+                self.misses += 1
+                gen = self._generation(course_id)
+            g = loader(course_id)
+            self.put(course_id, g, gen)
+        with self._lock:
+            self._load_locks.pop(course_id, None)
+        return g
+
+    def get_global(self, loader: Callable[[], Gallery]) -> Gallery:
+        g = self._global
+        if g is not None:
+            return g
+        with self._global_lock:
+            if self._global is None:
+                self._global = loader()
+            return self._global
+
+    def peek_global(self) -> Optional[Gallery]:
+        return self._global
+
+    def peek(self, course_id: int, count: bool = True) -> Optional[Gallery]:
+        with self._lock:
+            g = self._items.get(course_id)
+            if g is not None:
+                self._items.move_to_end(course_id)
+                if count:
+                    self.hits += 1
+            return g
+
+    def put(self, course_id: int, gallery: Gallery, generation: Optional[tuple] = None) -> None:
+        # generation: taken before the gallery was loaded; if the course
+        # changed since, the load may predate that change and is not cached
+        # (the caller still gets to use it, the next request reloads)
+        with self._lock:
+            if generation is not None and generation != self._generation(course_id):
+                self.stale_loads += 1
+                return
+            self._set(course_id, gallery)
+            self._evict()
+
+    def invalidate(self, course_id: int) -> None:
+        with self._lock:
+            self._bump([course_id])
+            old = self._items.pop(course_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+
+    def invalidate_global(self) -> None:
+        with self._global_lock:
+            old, self._global = self._global, None
+        if old is not None and old.index is not None and not old.index.ready:
+            # don't leave a graph build running for a gallery that's gone
+            old.index.cancel()
+
+    def adopt(self, key, versions: Optional[tuple]) -> None:
+        """After invalidating a shared key (course id or "global") for a
+        change already patched in here: ``versions`` is the (old, new)
+        version pair; a cached copy current for ``old`` is current for
+        ``new`` too and doesn't need a reload."""
+        if versions is None:
+            return
+        old, new = versions
+        if key == "global":
+            with self._global_lock:
+                if self._global is not None and self._global.version == old:
+                    self._global.version = new
+            return
+        with self._lock:
+            g = self._items.get(key)
+            if g is not None and g.version == old:
+                g.version = new
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._items.clear()
+            self._bytes = 0
+        self.invalidate_global()
+
+    def upsert_student(self, course_ids: Iterable[int], student_id: int, unit: np.ndarray, norm: float,
+                       include_global: bool = True) -> None:
+        # patch cached galleries of the student's courses in place; courses
+        # that aren't cached will pick up the new row on their next load
+        course_ids = list(course_ids)
+        with self._lock:
+            self._bump(course_ids)
+            for cid in course_ids:
+                g = self._items.get(cid)
+                if g is not None:
+                    self._set(cid, g.with_embedding(student_id, unit, norm), touch=False)
+            self._evict()
+        if include_global:
+            # under its own lock: course check-ins never wait on the (large)
+            # global patch, and a global load in progress is patched once done
+            with self._global_lock:
+                if self._global is not None:
+                    self._global = self._global.with_embedding(student_id, unit, norm)
+
+    def upsert_students(self, student_ids: np.ndarray, units: np.ndarray, norms: np.ndarray,
+                        course_ids: Sequence[Iterable[int]], include_global: bool = True) -> None:
+        # batch form of upsert_student (distinct ids; course_ids[i] are the
+        # courses of student_ids[i]): one patched copy per cached course
+        rows: Dict[int, List[int]] = {}
+        for i, cids in enumerate(course_ids):
+            for cid in cids:
+                rows.setdefault(cid, []).append(i)
+        with self._lock:
+            self._bump(rows)
+            for cid, idx in rows.items():
+                g = self._items.get(cid)
+                if g is not None:
+                    self._set(cid, g.with_rows(student_ids[idx], units[idx], norms[idx]), touch=False)
+            self._evict()
+        if include_global:
+            with self._global_lock:
+                if self._global is not None:
+                    self._global = self._global.with_rows(student_ids, units, norms)
+
+    def remove_student(self, student_id: int, course_ids: Optional[Iterable[int]] = None) -> None:
+        with self._lock:
+            if course_ids is None:
+                self._epoch += 1
+            targets = list(self._items) if course_ids is None else list(course_ids)
+            self._bump(targets)
+            for cid in targets:
+                g = self._items.get(cid)
+                if g is not None:
+                    self._set(cid, g.without(student_id), touch=False)
+        if course_ids is None:
+            with self._global_lock:
+                if self._global is not None:
+                    self._global = self._global.without(student_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "courses": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "stale_loads": self.stale_loads,
+                "global_rows": len(self._global) if self._global is not None else None,
+                "global_bytes": self._global.nbytes if self._global is not None else 0,
+            }
+
+    # --- internals (caller holds self._lock) ---
+    def _generation(self, course_id: int) -> tuple:
+        return self._epoch, self._gens.get(course_id, 0)
+
+    def _bump(self, course_ids: Iterable[int]) -> None:
+        for cid in course_ids:
+            self._gens[cid] = self._gens.get(cid, 0) + 1
+
+    def _set(self, course_id: int, gallery: Gallery, touch: bool = True) -> None:
+        old = self._items.get(course_id)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._items[course_id] = gallery
+        self._bytes += gallery.nbytes
+        if touch:
+            self._items.move_to_end(course_id)
+
+    def _evict(self) -> None:
+        # always keep the most recent entry, even if it alone is over budget
+        while self._bytes > self.max_bytes and len(self._items) > 1:
+            _, old = self._items.popitem(last=False)
+            self._bytes -= old.nbytes
+            self.evictions += 1
+
+
+galleries = GalleryCache()
@@ -0,0 +1,331 @@
+import heapq
+import math
+import os
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# graph degree, build-time and query-time beam widths
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "100"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+# rebuild the graph in the background once this share of its nodes are
+# tombstones (deleted or replaced), for graphs of at least HNSW_COMPACT_MIN
+HNSW_COMPACT_RATIO = float(os.getenv("HNSW_COMPACT_RATIO", "0.25"))
+HNSW_COMPACT_MIN = int(os.getenv("HNSW_COMPACT_MIN", "1000"))
+
+
+class _View(NamedTuple):
+    # what a search reads. Nodes are append-only and neighbor lists are
+    # swapped, never edited, so a view taken under the lock stays valid
+    # while writers go on; nodes added later (>= count) are skipped.
+    vectors: np.ndarray
+    labels: np.ndarray
+    deleted: np.ndarray
+    links: list
+    count: int
+    entry: int
+    max_level: int
+
+
+class HNSWIndex:
+    """Hierarchical navigable small world graph over unit vectors.
+
+    Distance is 1 - dot(q, x), i.e. cosine on the pre-normalized rows the
+    galleries already hold. Labels are student ids. Supports incremental
+    insert, replace and delete (deletes are tombstones that still route
+    searches but are never returned; ``compact()`` rebuilds without them,
+    and runs on its own once they pass HNSW_COMPACT_RATIO of the graph).
+
+    Searches only hold the lock to take a view of the graph, so they run
+    concurrently with each other and with inserts.
+    """
+
+    def __init__(self, dim: int, M: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION,
+                 ef_search: int = HNSW_EF_SEARCH, seed: int = 0):
+        self.dim = dim
+        self.M = M
+        self.M0 = 2 * M
+        self.ef_construction = max(ef_construction, M)
+        self.ef_search = ef_search
+        self._mult = 1.0 / math.log(M)
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._labels = np.zeros(0, dtype=np.int64)
+        self._deleted = np.zeros(0, dtype=bool)
+        self._links: List[List[np.ndarray]] = []  # node -> per-level neighbor arrays
+        self._node_of: Dict[int, int] = {}        # live label -> node
+        self._removed: set = set()                # labels deleted while a bulk build runs
+        self._log: Optional[list] = None          # writes made while compact() runs
+        self._count = 0
+        self._entry = -1
+        self._max_level = -1
+        # set by mark_ready() once a bulk load covers the whole gallery
+        self.ready = False
+        # set by cancel() to stop a bulk load nobody will use any more
+        self.cancelled = False
+        self.compactions = 0
+
+    def __len__(self) -> int:
+        return len(self._node_of)
+
+    @property
+    def nbytes(self) -> int:
+        # vectors + labels + roughly one full level-0 neighbor list per node
+        return self._vectors.nbytes + self._labels.nbytes + self._count * self.M0 * 8
+
+    @property
+    def tombstones(self) -> int:
+        return self._count - len(self._node_of)
+
+    # ---- writes ----
+    def add(self, label: int, unit: np.ndarray, replace: bool = True) -> None:
+        # replace=False is for bulk builders racing live updates: a label that
+        # was already patched in (or deleted) meanwhile is left alone
+        label = int(label)
+        with self._lock:
+            if not replace and (label in self._node_of or label in self._removed):
+                return
+            self._removed.discard(label)
+            q = np.asarray(unit, dtype=np.float32)
+            if self._log is not None:
+                self._log.append((label, q))
+            old = self._node_of.pop(label, None)
+            if old is not None:
+                self._deleted[old] = True
+            self._insert(label, q)
+            self._maybe_compact()
+
+    def remove(self, label: int) -> None:
+        label = int(label)
+        with self._lock:
+            self._removed.add(label)
+            if self._log is not None:
+                self._log.append((label, None))
+            node = self._node_of.pop(label, None)
+            if node is not None:
+                self._deleted[node] = True
+                self._maybe_compact()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def mark_ready(self) -> None:
+        with self._lock:
+            self._removed.clear()
+            self.ready = True
+
+    def compact(self) -> None:
+        """Rebuild the graph over the live nodes only, in place.
+
+        The new graph is built without the lock; writes made meanwhile are
+        logged and replayed onto it before it is swapped in.
+        """
+        with self._lock:
+            if self._log is not None:
+                return  # already running
+            self._log = []
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        # caller has set self._log; writes from then on are replayed (twice
+        # is harmless: adds replace, removes are idempotent)
+        with self._lock:
+            live = sorted(self._node_of.items(), key=lambda kv: kv[1])
+            vectors = self._vectors[[n for _, n in live]] if live else self._vectors[:0]
+        try:
+            fresh = HNSWIndex(self.dim, self.M, self.ef_construction, self.ef_search)
+            for (label, _), vec in zip(live, vectors):
+                fresh.add(label, vec)
+        except BaseException:
+            with self._lock:
+                self._log = None
+            raise
+        with self._lock:
+            for label, q in self._log:
+                if q is None:
+                    fresh.remove(label)
+                else:
+                    fresh.add(label, q)
+            self._vectors, self._labels, self._deleted = fresh._vectors, fresh._labels, fresh._deleted
+            self._links, self._node_of, self._count = fresh._links, fresh._node_of, fresh._count
+            self._entry, self._max_level = fresh._entry, fresh._max_level
+            self._log = None
+            self.compactions += 1
+
+    def labels(self) -> np.ndarray:
+        with self._lock:
+            return np.fromiter(self._node_of, dtype=np.int64, count=len(self._node_of))
+
+    # ---- persistence ----
+    def save(self, path: str) -> None:
+        """Write the graph to ``path`` (npz); ``load`` restores it as is."""
+        with self._lock:
+            n = self._count
+            links = [lvl for node in self._links[:n] for lvl in node]
+            arrays = {
+                "params": np.array([self.dim, self.M, self.ef_construction, self.ef_search,
+                                    self._entry, self._max_level, int(self.ready)], dtype=np.int64),
+                "vectors": self._vectors[:n].copy(),
+                "labels": self._labels[:n].copy(),
+                "deleted": self._deleted[:n].copy(),
+                "levels": np.fromiter((len(node) for node in self._links[:n]), dtype=np.int64, count=n),
+                "lens": np.fromiter((lvl.shape[0] for lvl in links), dtype=np.int64, count=len(links)),
+                "links": np.concatenate(links) if links else np.zeros(0, dtype=np.int64),
+            }
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "HNSWIndex":
+        with np.load(path) as z:
+            dim, M, ef_construction, ef_search, entry, max_level, ready = z["params"].tolist()
+            index = cls(dim, M, ef_construction, ef_search)
+            index._vectors = z["vectors"]
+            index._labels = z["labels"]
+            index._deleted = z["deleted"]
+            levels, lens, links = z["levels"], z["lens"], z["links"]
+        flat = np.split(links, np.cumsum(lens)[:-1]) if lens.shape[0] else []
+        bounds = np.concatenate([[0], np.cumsum(levels)]).tolist()
+        index._links = [flat[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        index._count = int(levels.shape[0])
+        index._node_of = {int(label): node for node, label in enumerate(index._labels.tolist())
+                          if not index._deleted[node]}
+        index._entry, index._max_level = entry, max_level
+        index.ready = bool(ready)
+        return index
+
+    # ---- reads ----
+    def search(self, unit: np.ndarray, k: int = 1, ef: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (labels, cosine similarities) of the k nearest live nodes."""
+        q = np.asarray(unit, dtype=np.float32)
+        with self._lock:
+            if self._entry < 0 or not self._node_of:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            view = self._view()
+        ep = view.entry
+        for level in range(view.max_level, 0, -1):
+            ep = self._greedy(view, q, ep, level)
+        found = self._search_layer(view, q, [ep], max(ef or self.ef_search, k), 0)
+        found = [(d, n) for d, n in found if not view.deleted[n]][:k]
+        nodes = np.fromiter((n for _, n in found), dtype=np.int64, count=len(found))
+        sims = np.fromiter((1.0 - d for d, _ in found), dtype=np.float32, count=len(found))
+        return view.labels[nodes], sims
+
+    # ---- internals (caller holds self._lock) ----
+    def _view(self) -> _View:
+        return _View(self._vectors, self._labels, self._deleted, self._links,
+                     self._count, self._entry, self._max_level)
+
+    def _maybe_compact(self) -> None:
+        if (self.ready and self._log is None and self._count >= HNSW_COMPACT_MIN
+                and self.tombstones > HNSW_COMPACT_RATIO * self._count):
+            self._log = []
+            threading.Thread(target=self._rebuild, name="hnsw-compact", daemon=True).start()
+
+    def _insert(self, label: int, q: np.ndarray) -> None:
+        node = self._count
+        if node == self._vectors.shape[0]:
+            cap = max(1024, 2 * node)
+            self._vectors = _grow(self._vectors, cap)
+            self._labels = _grow(self._labels, cap)
+            self._deleted = _grow(self._deleted, cap)
+        self._vectors[node] = q
+        self._labels[node] = label
+        self._deleted[node] = False
+        level = int(-math.log(1.0 - self._rng.random()) * self._mult)
+        self._links.append([np.zeros(0, dtype=np.int64) for _ in range(level + 1)])
+        self._count += 1
+        self._node_of[label] = node
+
+        if self._entry < 0:
+            self._entry, self._max_level = node, level
+            return
+
+        view = self._view()
+        ep = self._entry
+        for lc in range(self._max_level, level, -1):
+            ep = self._greedy(view, q, ep, lc)
+        eps = [ep]
+        for lc in range(min(level, self._max_level), -1, -1):
+            found = self._search_layer(view, q, eps, self.ef_construction, lc)
+            m_max = self.M0 if lc == 0 else self.M
+            nbrs = np.array([n for _, n in found[: self.M]], dtype=np.int64)
+            self._links[node][lc] = nbrs
+            for n in nbrs:
+                self._connect(int(n), node, lc, m_max)
+            eps = [n for _, n in found]
+
+        if level > self._max_level:
+            self._entry, self._max_level = node, level
+
+    def _connect(self, node: int, new: int, level: int, m_max: int) -> None:
+        links = np.append(self._links[node][level], new)
+        if links.shape[0] > m_max:
+            # keep the m_max closest neighbors
+            d = 1.0 - self._vectors[links] @ self._vectors[node]
+            links = links[np.argsort(d, kind="stable")[:m_max]]
+        self._links[node][level] = links
+
+    # ---- graph walks over a view (no lock needed) ----
+    @staticmethod
+    def _greedy(view: _View, q: np.ndarray, ep: int, level: int) -> int:
+        best_d = 1.0 - float(view.vectors[ep] @ q)
+        while True:
+            nbrs = view.links[ep][level]
+            nbrs = nbrs[nbrs < view.count]
+            if nbrs.shape[0] == 0:
+                return ep
+            d = 1.0 - view.vectors[nbrs] @ q
+            i = int(np.argmin(d))
+            if d[i] >= best_d:
+                return ep
+            ep, best_d = int(nbrs[i]), float(d[i])
+
+    @staticmethod
+    def _search_layer(view: _View, q: np.ndarray, eps: List[int], ef: int, level: int) -> List[Tuple[float, int]]:
+        visited = np.zeros(view.count, dtype=bool)
+        eps_arr = np.asarray(eps, dtype=np.int64)
+        visited[eps_arr] = True
+        d0 = (1.0 - view.vectors[eps_arr] @ q).tolist()
+        cand = list(zip(d0, eps_arr.tolist()))
+        heapq.heapify(cand)
+        best = [(-d, n) for d, n in cand]
+        heapq.heapify(best)
+        while len(best) > ef:
+            heapq.heappop(best)
+
+        while cand:
+            dc, c = heapq.heappop(cand)
+            if dc > -best[0][0]:
+                break
+            nbrs = view.links[c]
+            if level >= len(nbrs):
+                continue
+            nbrs = nbrs[level]
+            nbrs = nbrs[nbrs < view.count]
+            nbrs = nbrs[~visited[nbrs]]
+            if nbrs.shape[0] == 0:
+                continue
+            visited[nbrs] = True
+            ds = 1.0 - view.vectors[nbrs] @ q
+            worst = -best[0][0]
+            for dn, n in zip(ds.tolist(), nbrs.tolist()):
+                if len(best) < ef or dn < worst:
+                    heapq.heappush(cand, (dn, n))
+                    heapq.heappush(best, (-dn, n))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+                    worst = -best[0][0]
+        return sorted((-nd, n) for nd, n in best)
+
+
+def _grow(arr: np.ndarray, cap: int) -> np.ndarray:
+    out = np.zeros((cap,) + arr.shape[1:], dtype=arr.dtype)
+    out[: arr.shape[0]] = arr
+    return out
@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import psycopg
+
+from app.attendance_state import marks
+from app.db import db, get_db_url, instance_name
+from app.embeddings import stack_stored
+from app.gallery_cache import galleries
+from app.ivfpq import global_index
+from app.session_cache import sessions
+from app.shared_gallery import shared
+
+# Listen for the gallery_changes notifications sent by the triggers in
+# migrations/0004_gallery_notify.sql, 0005_sessions_notify.sql and
+# 0006_attendance_notify.sql and patch this process's caches, so a write on
+# another worker or node shows up here without polling.
+GALLERY_NOTIFY = os.getenv("GALLERY_NOTIFY", "1") == "1"
+CHANNEL = "gallery_changes"
+_BATCH = 256
+
+
+class ChangeListener:
+    """Background thread holding one LISTEN connection outside the pool.
+
+    Notifications are drained in small batches; the embeddings they refer
+    to are fetched with a single query per batch. After a reconnect the
+    caches are cleared, since anything sent while disconnected is lost.
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.connected = False
+        self.received = 0
+        self.skipped_own = 0
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="gallery-listener", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "received": self.received,
+            "skipped_own": self.skipped_own,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+        }
+
+    def _run(self) -> None:
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                with psycopg.connect(get_db_url(), autocommit=True, application_name=instance_name()) as conn:
+                    conn.execute(f"LISTEN {CHANNEL}")
+                    if attempt:
+                        # notifications sent while we were away are gone
+                        self.reconnects += 1
+                        galleries.clear()
+                        sessions.clear()
+                        marks.clear()
+                    self.connected, attempt = True, 0
+                    while not self._stop.is_set():
+                        batch = [json.loads(n.payload) for n in conn.notifies(timeout=0.5, stop_after=_BATCH)]
+                        if batch:
+                            self.apply(batch)
+            except Exception as e:
+                self.last_error = str(e)
+            self.connected = False
+            attempt += 1
+            self._stop.wait(min(30.0, 2.0 ** attempt))
+
+    def apply(self, batch: List[dict]) -> None:
+        own = instance_name()
+        events = []
+        for p in batch:
+            self.received += 1
+            if p["table"] == "sessions":
+                sessions.invalidate((p["session_id"], p["course_id"]))
+                marks.invalidate(p["session_id"])
+            elif p["table"] == "attendance":
+                marks.invalidate(p["session_id"])
+            elif p.get("origin") == own:
+                # written by this process, which patched its caches already
+                self.skipped_own += 1
+            else:
+                events.append(p)
+        if not events:
+            return
+
+        # current embedding + enrollments of every student an insert/update
+        # touched; later events in the batch are covered by reading the
+        # latest state once
+        wanted = sorted({p["student_id"] for p in events if p["op"] != "DELETE"})
+        current = {}
+        if wanted:
+            with db() as conn, conn.cursor(binary=True) as cur:
+                cur.execute(
+                    """
+                    SELECT se.student_id, se.embedding_vec, se.embedding_norm,
+                           CASE WHEN se.embedding_vec IS NULL THEN se.embedding END,
+                           ARRAY(SELECT e.course_id FROM public.enrollments e
+                                 WHERE e.student_id = se.student_id)
+                    FROM public.student_embeddings se
+                    WHERE se.student_id = ANY(%s)
+                    """,
+                    (wanted,),
+                )
+                rows = cur.fetchall()
+            ids, units, norms = stack_stored([r[:4] for r in rows])
+            courses = {r[0]: list(r[4]) for r in rows}
+            current = {int(sid): (unit, float(norm), courses[int(sid)])
+                       for sid, unit, norm in zip(ids, units, norms)}
+
+        # last word per student (embedding rows) and per enrollment, then
+        # one batched patch per cached gallery, as for bulk saves
+        embedded = {p["student_id"] for p in events if p["table"] == "student_embeddings"}
+        enrolled = {}
+        for p in events:
+            if p["table"] != "student_embeddings":
+                enrolled[(p["student_id"], p["course_id"])] = p["op"]
+
+        touched, dropped = set(), set()
+        for sid in sorted(embedded - current.keys()):
+            galleries.remove_student(sid)
+            global_index.remove(sid)
+            dropped.add(sid)
+        left: Dict[int, List[int]] = {}
+        joined: Dict[int, List[int]] = {}
+        for (sid, cid), op in enrolled.items():
+            touched.add(cid)
+            if op == "INSERT" and sid in current:
+                joined.setdefault(sid, []).append(cid)
+            else:
+                left.setdefault(sid, []).append(cid)
+        for sid, cids in left.items():
+            galleries.remove_student(sid, cids)
+
+        saved = sorted(embedded & current.keys())
+        if saved:
+            for sid in saved:
+                unit, norm, _ = current[sid]
+                global_index.add(sid, unit, norm)
+                touched.update(current[sid][2])
+            galleries.upsert_students(*self._stack(current, saved), [current[sid][2] for sid in saved])
+        joined_ids = sorted(joined)
+        if joined_ids:
+            galleries.upsert_students(*self._stack(current, joined_ids), [joined[sid] for sid in joined_ids],
+                                      include_global=False)
+
+        if shared is not None:
+            keys = set(shared.directory()) if dropped else {str(cid) for cid in touched}
+            if dropped or saved:
+                keys.add("global")
+            for key in sorted(keys):
+                shared.invalidate(key)
+
+    @staticmethod
+    def _stack(current: dict, student_ids: List[int]):
+        # (ids, units, norms) rows of the given students for upsert_students
+        units = np.stack([current[sid][0] for sid in student_ids])
+        norms = np.array([current[sid][1] for sid in student_ids], dtype=np.float32)
+        return np.array(student_ids, dtype=np.int64), units, norms
+
+
+listener = ChangeListener() if GALLERY_NOTIFY else None
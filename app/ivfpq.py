@@ -0,0 +1,370 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from app.matching import METRIC, Match, normalize
+
+# coarse lists, sub-quantizers (bytes per code), lists probed per query and
+# candidates re-ranked exactly
+IVFPQ_NLIST = int(os.getenv("IVFPQ_NLIST", "0"))  # 0 = ~4*sqrt(n)
+IVFPQ_M = int(os.getenv("IVFPQ_M", "16"))
+IVFPQ_NPROBE = int(os.getenv("IVFPQ_NPROBE", "16"))
+IVFPQ_RERANK = int(os.getenv("IVFPQ_RERANK", "64"))
+IVFPQ_DIR = os.getenv("IVFPQ_DIR", "data/ivfpq")
+
+_KSUB = 256  # 8-bit codes
+
+
+def _kmeans(x: np.ndarray, k: int, iters: int = 20, seed: int = 0) -> np.ndarray:
+    # plain Lloyd iterations; empty clusters are re-seeded from random points
+    rng = np.random.default_rng(seed)
+    k = min(k, x.shape[0])
+    c = x[rng.choice(x.shape[0], k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest(x, c)
+        sums = np.zeros_like(c)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        c[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            c[empty] = x[rng.choice(x.shape[0], int(empty.sum()), replace=False)]
+    return c
+
+
+def _nearest(x: np.ndarray, c: np.ndarray, chunk: int = 16384) -> np.ndarray:
+    c_sq = (c * c).sum(axis=1)
+    out = np.empty(x.shape[0], dtype=np.int64)
+    for s in range(0, x.shape[0], chunk):
+        block = x[s : s + chunk]
+        out[s : s + chunk] = np.argmin(c_sq[None, :] - 2.0 * block @ c.T, axis=1)
+    return out
+
+
+class IVFPQIndex:
+    """Inverted-file index with product-quantized residual codes.
+
+    Vectors are the unit-normalized gallery rows. Each one is assigned to a
+    coarse centroid and its residual is encoded as M one-byte sub-codes, so
+    the in-memory footprint is M bytes per vector instead of 4*dim. Queries
+    probe the nprobe closest lists with asymmetric distance computation
+    (query kept in float, codes looked up in per-query tables) and then
+    re-rank the best candidates exactly against the full vectors, which stay
+    on disk as a memory-mapped file shared through the page cache.
+
+    Embeddings saved after the last build go to a small exact delta buffer,
+    and deletes are tombstones, until the next rebuild.
+    """
+
+    def __init__(self, centroids, codebooks, list_offsets, codes, rows, ids, norms, vectors, meta):
+        self.centroids = centroids        # (nlist, dim)
+        self.codebooks = codebooks        # (M, 256, dim/M)
+        self.list_offsets = list_offsets  # (nlist + 1,) into codes/rows
+        self.codes = codes                # (n, M) uint8, grouped by list
+        self.rows = rows                  # (n,) row in ids/norms/vectors per code
+        self.ids = ids                    # (n,) student ids
+        self.norms = norms                # (n,) original embedding norms
+        self.vectors = vectors            # (n, dim) float32, usually np.memmap
+        self.meta = meta
+        self._lock = threading.Lock()
+        self._delta: Dict[int, Tuple[np.ndarray, float]] = {}
+        self._dead = np.zeros(ids.shape[0], dtype=bool)
+        self._by_id = np.argsort(ids, kind="stable")
+
+    # ---- build / persist ----
+    @classmethod
+    def train(cls, ids: np.ndarray, units: np.ndarray, norms: np.ndarray,
+              nlist: int = IVFPQ_NLIST, m: int = IVFPQ_M, sample: int = 100_000) -> "IVFPQIndex":
+        n, dim = units.shape
+        if n == 0:
+            raise ValueError("no embeddings to index")
+        if dim % m:
+            raise ValueError(f"dim {dim} is not divisible by IVFPQ_M={m}")
+        nlist = nlist or int(np.clip(4 * np.sqrt(n), 1, 4096))
+        rng = np.random.default_rng(0)
+        train = units[rng.choice(n, min(n, sample), replace=False)]
+
+        centroids = _kmeans(train, nlist)
+        nlist = centroids.shape[0]
+        assign = _nearest(units, centroids)
+        residuals = units - centroids[assign]
+
+        dsub = dim // m
+        t_res = train - centroids[_nearest(train, centroids)]
+        codebooks = np.zeros((m, _KSUB, dsub), dtype=np.float32)
+        codes = np.zeros((n, m), dtype=np.uint8)
+        for j in range(m):
+            sl = slice(j * dsub, (j + 1) * dsub)
+            cb = _kmeans(t_res[:, sl], _KSUB, iters=15, seed=j)
+            codebooks[j, : cb.shape[0]] = cb
+            if cb.shape[0] < _KSUB:
+                # tiny galleries: unused slots must never be nearest
+                codebooks[j, cb.shape[0]:] = np.inf
+            codes[:, j] = _nearest(residuals[:, sl], codebooks[j, : cb.shape[0]])
+
+        order = np.argsort(assign, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+        meta = {"n": int(n), "dim": int(dim), "nlist": int(nlist), "m": int(m), "built_at": time.time()}
+        return cls(
+            centroids.astype(np.float32), codebooks, list_offsets, codes[order],
+            order.astype(np.int32), np.asarray(ids, dtype=np.int64),
+            np.asarray(norms, dtype=np.float32), np.ascontiguousarray(units, dtype=np.float32), meta,
+        )
+
+    def save(self, path: str) -> None:
+        # write into a sibling temp dir and swap, so readers never see half an
+        # index; temp names are per process, the swap is under the swap lock
+        tmp = f"{path.rstrip('/')}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.savez(
+            os.path.join(tmp, "ivfpq.npz"),
+            centroids=self.centroids, codebooks=self.codebooks, list_offsets=self.list_offsets,
+            codes=self.codes, rows=self.rows, ids=self.ids, norms=self.norms,
+        )
+        np.save(os.path.join(tmp, "vectors.npy"), np.asarray(self.vectors))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        old = f"{path.rstrip('/')}.{os.getpid()}.old"
+        shutil.rmtree(old, ignore_errors=True)
+        with _locked(path, "swap"):
+            if os.path.exists(path):
+                os.rename(path, old)
+            os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFPQIndex":
+        with _locked(path, "swap", fcntl.LOCK_SH):
+            with np.load(os.path.join(path, "ivfpq.npz")) as z:
+                parts = {k: z[k] for k in z.files}
+            vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+        return cls(parts["centroids"], parts["codebooks"], parts["list_offsets"], parts["codes"],
+                   parts["rows"], parts["ids"], parts["norms"], vectors, meta)
+
+    # ---- live updates until the next rebuild ----
+    def add(self, student_id: int, unit: np.ndarray, norm: float) -> None:
+        with self._lock:
+            self._delta[int(student_id)] = (np.asarray(unit, dtype=np.float32), float(norm))
+            row = self._row_of(student_id)
+            if row is not None:
+                self._dead[row] = True
+
+    def remove(self, student_id: int) -> None:
+        with self._lock:
+            self._delta.pop(int(student_id), None)
+            row = self._row_of(student_id)
+            if row is not None:
+                self._dead[row] = True
+
+    def replay_onto(self, other: "IVFPQIndex") -> None:
+        # carry this index's live updates over to a newer build of the same
+        # table: saved embeddings again, deletes of rows it still has
+        with self._lock:
+            delta = list(self._delta.items())
+            dead = np.setdiff1d(self.ids[self._dead], np.fromiter(self._delta, dtype=np.int64))
+        for sid in dead.tolist():
+            other.remove(sid)
+        for sid, (unit, norm) in delta:
+            other.add(sid, unit, norm)
+
+    def _row_of(self, student_id: int) -> Optional[int]:
+        i = int(np.searchsorted(self.ids, student_id, sorter=self._by_id))
+        if i < self.ids.shape[0] and self.ids[self._by_id[i]] == student_id:
+            return int(self._by_id[i])
+        return None
+
+    # ---- search ----
+    def __len__(self) -> int:
+        return int((~self._dead).sum()) + len(self._delta)
+
+    @property
+    def nbytes(self) -> int:
+        # resident part only; full vectors are mmap'd from disk
+        return (self.centroids.nbytes + self.codebooks.nbytes + self.list_offsets.nbytes
+                + self.codes.nbytes + self.rows.nbytes + self.ids.nbytes + self.norms.nbytes)
+
+    def candidates(self, unit: np.ndarray, nprobe: int = IVFPQ_NPROBE, k: int = IVFPQ_RERANK) -> np.ndarray:
+        """Rows (into ids/vectors) of the k best ADC candidates."""
+        m, _, dsub = self.codebooks.shape
+        c_d = ((self.centroids - unit) ** 2).sum(axis=1)
+        probe = np.argsort(c_d)[: min(nprobe, c_d.shape[0])]
+        rows, dists = [], []
+        for lst in probe:
+            a, b = self.list_offsets[lst], self.list_offsets[lst + 1]
+            if a == b:
+                continue
+            # per-query lookup table: squared distance of each query sub-vector
+            # (residual to this list's centroid) to every sub-centroid
+            r = (unit - self.centroids[lst]).reshape(m, 1, dsub)
+            lut = ((self.codebooks - r) ** 2).sum(axis=2)
+            codes = self.codes[a:b]
+            dists.append(lut[np.arange(m), codes].sum(axis=1))
+            rows.append(self.rows[a:b])
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+        rows, dists = np.concatenate(rows), np.concatenate(dists)
+        keep = ~self._dead[rows]
+        rows, dists = rows[keep], dists[keep]
+        if rows.shape[0] > k:
+            top = np.argpartition(dists, k)[:k]
+            rows = rows[top]
+        return rows
+
+    def best_match(self, live, metric: Optional[str] = None) -> Optional[Match]:
+        unit, q_norm = normalize(live, self.centroids.shape[1])
+        rows = np.sort(self.candidates(unit))
+        with self._lock:
+            delta = list(self._delta.items())
+        ids = np.concatenate([self.ids[rows], np.array([sid for sid, _ in delta], dtype=np.int64)])
+        if ids.shape[0] == 0:
+            return None
+        # exact re-rank: full vectors for the candidates plus the delta buffer
+        vecs = np.asarray(self.vectors[rows], dtype=np.float32)
+        if delta:
+            vecs = np.vstack([vecs, np.stack([v for _, (v, _) in delta])])
+        norms = np.concatenate([self.norms[rows], np.array([nm for _, (_, nm) in delta], dtype=np.float32)])
+        cos = vecs @ unit
+        d = np.sqrt(np.maximum(q_norm * q_norm + norms * norms - 2.0 * q_norm * norms * cos, 0.0))
+        i = int(np.argmin(d)) if (metric or METRIC) == "euclidean" else int(np.argmax(cos))
+        return Match(int(ids[i]), float(cos[i]), float(d[i]))
+
+
+@contextmanager
+def _locked(path: str, name: str, op: int = fcntl.LOCK_EX) -> Iterator[None]:
+    # cross-process lock next to the index directory
+    lock = f"{path.rstrip('/')}.{name}.lock"
+    os.makedirs(os.path.dirname(lock) or ".", exist_ok=True)
+    with open(lock, "a") as f:
+        fcntl.flock(f, op)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class IndexSlot:
+    """Holds the process-wide IVF-PQ index and rebuilds it in the background.
+
+    Worker processes share the index directory: one rebuild runs at a time
+    across all of them (the "build" lock), and every worker switches to a
+    newer build once ``meta.json`` changes, carrying its live updates over.
+    """
+
+    def __init__(self, path: str = IVFPQ_DIR):
+        self.path = path
+        self.index: Optional[IVFPQIndex] = None
+        self.building = False
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        # meta.json mtime of the build self.index was loaded from
+        self._mtime: Optional[int] = None
+        # updates seen while a rebuild runs, replayed onto the new index
+        self._pending: list = []
+
+    def load(self) -> bool:
+        mtime = self._meta_mtime()
+        if mtime is None:
+            return False
+        fresh = IVFPQIndex.load(self.path)
+        with self._lock:
+            if self.index is not None:
+                self.index.replay_onto(fresh)
+            self.index, self._mtime = fresh, mtime
+        return True
+
+    def current(self) -> Optional[IVFPQIndex]:
+        """The index to search, reloaded first if another worker rebuilt it."""
+        mtime = self._meta_mtime()
+        if mtime is not None and mtime != self._mtime and not self.building:
+            if self._reload_lock.acquire(blocking=False):
+                try:
+                    self.load()
+                except (OSError, ValueError, KeyError) as e:
+                    self.last_error = repr(e)  # keep serving the one we have
+                finally:
+                    self._reload_lock.release()
+        return self.index
+
+    def _meta_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(self.path, "meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def add(self, student_id: int, unit: np.ndarray, norm: float) -> None:
+        with self._lock:
+            if self.building:
+                self._pending.append((student_id, unit, norm))
+            if self.index is not None:
+                self.index.add(student_id, unit, norm)
+
+    def remove(self, student_id: int) -> None:
+        with self._lock:
+            if self.building:
+                self._pending.append((student_id, None, None))
+            if self.index is not None:
+                self.index.remove(student_id)
+
+    def rebuild(self, fetch: Callable[[], Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> bool:
+        # returns False if a rebuild is already running
+        with self._lock:
+            if self.building:
+                return False
+            self.building = True
+            self._pending = []
+        threading.Thread(target=self._rebuild, args=(fetch, self._meta_mtime()),
+                         name="ivfpq-build", daemon=True).start()
+        return True
+
+    def _rebuild(self, fetch, requested_mtime: Optional[int]) -> None:
+        try:
+            with _locked(self.path, "build"):
+                if self._meta_mtime() != requested_mtime:
+                    # another worker finished a rebuild while we waited: use it
+                    self.load()
+                    return
+                built = IVFPQIndex.train(*fetch())
+                built.save(self.path)
+                mtime = self._meta_mtime()
+            # reopen so the full vectors are served from the mmap'd file
+            fresh = IVFPQIndex.load(self.path)
+            with self._lock:
+                for student_id, unit, norm in self._pending:
+                    if unit is None:
+                        fresh.remove(student_id)
+                    else:
+                        fresh.add(student_id, unit, norm)
+                self.index, self._mtime = fresh, mtime
+            self.last_error = None
+        except Exception as e:  # keep serving the previous index
+            self.last_error = repr(e)
+        finally:
+            with self._lock:
+                self.building = False
+                self._pending = []
+
+    def stats(self) -> dict:
+        idx = self.index
+        return {
+            "loaded": idx is not None,
+            "building": self.building,
+            "last_error": self.last_error,
+            "rows": len(idx) if idx is not None else 0,
+            "resident_bytes": idx.nbytes if idx is not None else 0,
+            **({"meta": idx.meta} if idx is not None else {}),
+        }
+
+
+global_index = IndexSlot()
@@ -1,15 +1,70 @@
-import json
-from psycopg.types.json import Json   # <— NEW (psycopg3 helper for JSON)
-
-from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi import (APIRouter, Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket,
+                     WebSocketDisconnect)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List, Optional, Tuple
+import hmac
 import os
-import psycopg
+import threading
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
 
-app = FastAPI(title="Face Attendance API")
+import numpy as np
+import orjson
+
+from app.attendance_state import marks
+from app.attendance_writer import writer
+from app.coalescer import coalescer
+from app.db import (adb, async_pool_stats, close_async_pool, close_pool, db, open_async_pool,
+                    open_pool, pool_stats)
+from app.embeddings import (BASE64_CONTENT_TYPE, BINARY_CONTENT_TYPE, embedding_from_list, pack_embedding,
+                            parse_embedding, stack_stored)
+from app import bulk_import, executors, export
+from app.executors import match_gallery, run_db, run_matching
+from app.gallery_cache import galleries
+from app.invalidation import listener
+from app.ivfpq import global_index
+from app.matching import EMBEDDING_DIM, Gallery, normalize
+from app.session_cache import sessions
+from app.shared_gallery import shared
+from app.snapshots import snapshots
+from app.streaming import TrackVoter
+
+# global identification backend: "gallery" keeps every embedding in memory
+# (HNSW once large); "ivfpq" serves the compressed on-disk IVF-PQ index
+GLOBAL_INDEX = os.getenv("GLOBAL_INDEX", "gallery")
+# shared secret for /api/admin/* and the bulk import, sent as X-Admin-Token;
+# unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # open the DB pool once; if DB_URL is missing the API still boots and
+    # DB endpoints report the error lazily
+    try:
+        open_pool()
+        await open_async_pool()
+        if listener is not None:
+            listener.start()
+    except HTTPException:
+        pass
+    if GLOBAL_INDEX == "ivfpq":
+        global_index.load()
+    if writer is not None:
+        writer.start()
+    if snapshots is not None:
+        threading.Thread(target=_warm_from_snapshots, name="snapshot-warm", daemon=True).start()
+    yield
+    if listener is not None:
+        listener.stop()
+    if writer is not None:
+        writer.stop()
+    await close_async_pool()
+    close_pool()
+    executors.shutdown()
+
+app = FastAPI(title="Face Attendance API", lifespan=lifespan)
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -30,164 +85,841 @@ def preflight(rest_of_path: str):
     return Response(status_code=204)
 
 @app.get("/")
-def health():
+async def health():
     return {"ok": True}
 
-# ---- DB helper (lazy; won't crash server at import) ----
-def get_db_url() -> str:
-    db_url = os.getenv("DB_URL")
-    if not db_url:
-        raise HTTPException(status_code=500, detail="DB_URL environment variable is not set")
-    return db_url
+def _require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+# every /api/admin route goes through the token check
+admin = APIRouter(prefix="/api/admin", dependencies=[Depends(_require_admin)])
+
+@admin.get("/stats")
+def stats():
+    return {
+        "db_pool": pool_stats(),
+        "db_async_pool": async_pool_stats(),
+        "gallery_cache": galleries.stats(),
+        "global_index": global_index.stats(),
+        "shared_galleries": shared.stats() if shared is not None else None,
+        "snapshots": snapshots.stats() if snapshots is not None else None,
+        "change_listener": listener.stats() if listener is not None else None,
+        "session_cache": sessions.stats(),
+        "attendance_writer": writer.stats() if writer is not None else None,
+        "attendance_marks": marks.stats(),
+        "checkin_coalescer": coalescer.stats() if coalescer is not None else None,
+        "executors": executors.stats(),
+    }
 
-def db():
-    return psycopg.connect(get_db_url(), autocommit=True)
+@admin.post("/index/rebuild")
+def rebuild_global_index():
+    # retrain the IVF-PQ index from public.student_embeddings in the
+    # background; the current index keeps serving until the new one is saved
+    started = global_index.rebuild(_fetch_all_embeddings)
+    return {"ok": True, "started": started, "building": global_index.building}
+
+@admin.get("/embeddings/export")
+async def export_embeddings(
+    fmt: str = Query("binary", alias="format"),
+    after: Optional[int] = Query(None),
+    until: Optional[int] = Query(None),
+    since: Optional[int] = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+):
+    # every stored embedding, streamed in student_id order (see
+    # app/export.py for the formats); resume a cut-off download with
+    # after=<last id received>, fetch changes with since=<X-Export-Stamp>
+    if fmt not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(export.FORMATS)}")
+    if fmt == "arrow" and export.pa is None:
+        raise HTTPException(status_code=501, detail="Arrow export needs pyarrow installed")
+    stamp, body = await export.open_export(fmt, after, until, since, limit)
+    return StreamingResponse(body, media_type=export.MEDIA_TYPES[fmt], headers={
+        "X-Export-Stamp": str(stamp),
+        "X-Embedding-Dim": str(EMBEDDING_DIM),
+    })
+
+app.include_router(admin)
 
 # ---- Models (keep it simple for OpenAPI & client) ----
 class EmbeddingIn(BaseModel):
     embedding: List[float]
 
-import os
-from fastapi import HTTPException
-import psycopg
-
-def _normalize_pg_url(url: str) -> str:
-    # Render sometimes gives postgres:// instead of postgresql://
-    if url.startswith("postgres://"):
-        url = "postgresql://" + url[len("postgres://"):]
-    # Ensure sslmode=require is always present
-    if "sslmode=" not in url:
-        sep = "&" if "?" in url else "?"
-        url = f"{url}{sep}sslmode=require"
-    return url
-
-def get_db_url() -> str:
-    url = os.getenv("DB_URL") or os.getenv("DATABASE_URL")
-    if not url:
-        raise HTTPException(
-            status_code=500,
-            detail="Missing DB_URL / DATABASE_URL environment variable"
+# checkin-vec and save_embedding parse their body themselves so the binary
+# formats skip JSON and per-float validation entirely; this documents them
+_EMBEDDING_BODY = {"requestBody": {"required": True, "content": {
+    "application/json": {"schema": EmbeddingIn.model_json_schema()},
+    BINARY_CONTENT_TYPE: {"schema": {"type": "string", "format": "binary",
+                                     "description": "packed little-endian float32"}},
+    BASE64_CONTENT_TYPE: {"schema": {"type": "string", "format": "byte",
+                                     "description": "base64 of packed little-endian float32"}},
+}}}
+
+async def _read_embedding(request: Request) -> np.ndarray:
+    # JSON via orjson, or packed float32 (raw / base64) viewed in place;
+    # X-Embedding-Dim, if sent, must match the packed length
+    try:
+        return parse_embedding(await request.body(), request.headers.get("content-type", ""),
+                               request.headers.get("x-embedding-dim"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ===== 1) Save/Update a student's face embedding (stored as float32 bytea) =====
+# one round trip: check the user is a student, store the unit vector as
+# packed float32 bytea plus its norm (clearing the legacy JSONB column) only
+# if so, and list their courses
+_SAVE_EMBEDDING_SQL = """
+    WITH u AS (
+        SELECT role FROM public.users WHERE id = %(sid)s
+    ), saved AS (
+        INSERT INTO public.student_embeddings
+            (student_id, embedding_vec, embedding_norm, embedding)
+        SELECT %(sid)s, %(vec)s, %(norm)s, NULL FROM u WHERE u.role = 'student'
+        ON CONFLICT (student_id)
+        DO UPDATE SET embedding_vec = EXCLUDED.embedding_vec,
+                      embedding_norm = EXCLUDED.embedding_norm,
+                      embedding = NULL,
+                      created_at = NOW()
+    )
+    SELECT u.role,
+           ARRAY(SELECT course_id FROM public.enrollments WHERE student_id = %(sid)s)
+    FROM u
+"""
+
+@app.post("/api/students/{student_id}/embedding", openapi_extra=_EMBEDDING_BODY)
+async def save_embedding(student_id: int, request: Request):
+    # at most 128 dims are kept (face-api.js descriptor length)
+    emb = await _read_embedding(request)
+    # normalize once here so matching is a plain dot product
+    unit, norm = normalize(emb)
+    if norm == 0:
+        raise HTTPException(status_code=400, detail="Invalid embedding (zero vector)")
+
+    async with adb() as conn, conn.cursor() as cur:
+        await cur.execute(
+            _SAVE_EMBEDDING_SQL,
+            {"sid": student_id, "vec": pack_embedding(unit), "norm": norm},
+            prepare=True,
         )
-    return _normalize_pg_url(url)
+        row = await cur.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Student not found")
+    if row[0] != "student":
+        raise HTTPException(status_code=400, detail="User is not a student")
 
-def db():
-    return psycopg.connect(get_db_url(), autocommit=True)
+    # patch cached galleries of every course this student is in (index
+    # inserts are CPU work, so off the event loop)
+    await run_matching(_patch_caches, list(row[1]), student_id, unit, norm)
+    return {"ok": True, "student_id": student_id, "saved_dims": len(emb)}
 
-# ===== 1) Save/Update a student's face embedding (stored as JSONB) =====
-@app.post("/api/students/{student_id}/embedding")
-def save_embedding(student_id: int, body: EmbeddingIn):
-    emb = body.embedding
-    if not isinstance(emb, list) or len(emb) < 64:
-        raise HTTPException(status_code=400, detail="Invalid embedding length")
-    # keep at most 128 dims (face-api.js descriptor length)
-    emb = emb[:128]
+def _patch_caches(course_ids: List[int], student_id: int, unit: np.ndarray, norm: float) -> None:
+    # shared copies are dropped before ours are patched, so nothing can map
+    # a pre-write file in between; our patched copies then stay current
+    versions = _invalidate_shared(course_ids + ["global"])
+    galleries.upsert_student(course_ids, student_id, unit, norm)
+    global_index.add(student_id, unit, norm)
+    _adopt_shared(versions)
 
-    with db() as conn, conn.cursor() as cur:
-        # validate user exists and is a student
-        cur.execute("SELECT role FROM public.users WHERE id=%s", (student_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Student not found")
-        if row[0] != "student":
-            raise HTTPException(status_code=400, detail="User is not a student")
-
-        # store as JSONB using psycopg3's Json wrapper
-        cur.execute(
+def _invalidate_shared(keys: list) -> dict:
+    # other workers see the entries disappear and one of them reloads
+    if shared is None:
+        return {}
+    return {key: shared.invalidate(key) for key in keys}
+
+def _adopt_shared(versions: dict) -> None:
+    for key, v in versions.items():
+        galleries.adopt(key, v)
+
+def _is_stale(key, gallery: Gallery) -> bool:
+    # with the change listener connected every worker patches its own copy
+    # for every write, so only the published files need dropping; without
+    # it, a copy is stale once another worker invalidated the key
+    if shared is None or (listener is not None and listener.connected):
+        return False
+    return shared.is_stale(key, gallery)
+
+# ===== 1b) Bulk enrollment: streamed NDJSON or binary records =====
+# at most this many per-record errors are listed (all are counted)
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "1000"))
+
+# rewrites templates for many students at once: admin token required
+@app.post("/api/students/embeddings/bulk", dependencies=[Depends(_require_admin)])
+async def save_embeddings_bulk(request: Request):
+    # records are COPY'd and merged chunk by chunk as they arrive (see
+    # app/bulk_import.py); errors are reported per record
+    summary = {"records": 0, "saved": 0, "superseded": 0, "error_count": 0, "errors": []}
+
+    def report(errors: List[dict]) -> None:
+        summary["error_count"] += len(errors)
+        summary["errors"].extend(errors[: max(0, BULK_MAX_ERRORS - len(summary["errors"]))])
+
+    async with bulk_import.slots, adb() as conn:
+        try:
+            async for chunk, errors in bulk_import.read_chunks(
+                request.stream(), request.headers.get("content-type", ""), request.headers.get("x-embedding-dim")
+            ):
+                rows = await bulk_import.merge_chunk(conn, chunk) if len(chunk) else []
+                summary["records"] += len(chunk) + len(errors)
+                summary["superseded"] += len(chunk) - len(rows)
+                saved = [r for r in rows if r[2] == "student"]
+                summary["saved"] += len(saved)
+                report(sorted(errors + [
+                    {"record": r[0], "student_id": r[1],
+                     "detail": "Student not found" if r[2] is None else "User is not a student"}
+                    for r in rows if r[2] != "student"
+                ], key=lambda e: e["record"]))
+                if saved:
+                    await run_matching(_patch_caches_many, chunk, saved)
+        except ValueError as e:
+            # chunks merged so far stay saved
+            raise HTTPException(status_code=400, detail={"error": str(e), **summary})
+    return {"ok": summary["error_count"] == 0, **summary}
+
+def _patch_caches_many(chunk: "bulk_import.Chunk", saved: list) -> None:
+    # saved: merge rows (record, student_id, role, course_ids) of stored students
+    idx = np.searchsorted(chunk.records, [r[0] for r in saved])
+    ids, units, norms = chunk.ids[idx], chunk.units[idx], chunk.norms[idx]
+    course_ids = [list(r[3]) for r in saved]
+    versions = _invalidate_shared(sorted({cid for cids in course_ids for cid in cids}) + ["global"])
+    galleries.upsert_students(ids, units, norms, course_ids)
+    for sid, unit, norm in zip(ids, units, norms):
+        global_index.add(int(sid), unit, float(norm))
+    _adopt_shared(versions)
+
+def _stamped(conn, query: str, params=None):
+    # run query together with a DB version stamp, pipelined into one round
+    # trip. Every transaction still open when the stamp is taken has an
+    # xid >= this xmin, so whatever it writes later carries
+    # student_embeddings.version >= the stamp.
+    with conn.pipeline(), conn.cursor() as stamp_cur, conn.cursor(binary=True) as cur:
+        stamp_cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+        cur.execute(query, params)
+        return stamp_cur.fetchone()[0], cur.fetchall()
+
+def _refresh_snapshot(conn, key: str, course_id, gallery: Gallery, stamp: int) -> Gallery:
+    # bring a snapshot up to date: one query lists the current members and
+    # returns embeddings only for rows written since the stamp or missing
+    # from the snapshot
+    scope = (
+        "JOIN public.enrollments e ON e.student_id = se.student_id WHERE e.course_id = %(course_id)s"
+        if course_id is not None else ""
+    )
+    now, rows = _stamped(
+        conn,
+        f"""
+        SELECT student_id, changed,
+               CASE WHEN changed THEN embedding_vec END, embedding_norm,
+               CASE WHEN changed AND embedding_vec IS NULL THEN embedding END
+        FROM (
+            SELECT se.*, (se.version >= %(stamp)s OR NOT se.student_id = ANY(%(ids)s)) AS changed
+            FROM public.student_embeddings se
+            {scope}
+        ) t
+        """,
+        {"course_id": course_id, "stamp": stamp, "ids": gallery.ids.tolist()},
+    )
+    present = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    changed = [(r[0], r[2], r[3], r[4]) for r in rows if r[1]]
+    if not changed and len(present) == len(gallery):
+        return gallery
+    gallery = gallery.with_rows(*stack_stored(changed), keep_ids=present)
+    snapshots.save_later(key, gallery, now)
+    return gallery
+
+def _load_gallery(conn, course_id: int) -> Gallery:
+    key = f"course-{course_id}"
+    snap = snapshots.load(key) if snapshots is not None else None
+    if snap is not None:
+        gallery = _refresh_snapshot(conn, key, course_id, *snap)
+        gallery.ensure_index()
+        return gallery
+    # get embeddings for students enrolled in this course; binary cursor so
+    # bytea comes back as raw bytes ready for np.frombuffer
+    stamp, rows = _stamped(
+        conn,
+        """
+        SELECT se.student_id, se.embedding_vec, se.embedding_norm,
+               CASE WHEN se.embedding_vec IS NULL THEN se.embedding END
+        FROM public.student_embeddings se
+        JOIN public.enrollments e ON e.student_id = se.student_id
+        WHERE e.course_id = %s
+        """,
+        (course_id,),
+    )
+    gallery = Gallery(*stack_stored(rows))
+    # no-op for normal class sizes; very large galleries get an ANN index
+    gallery.ensure_index()
+    if snapshots is not None:
+        snapshots.save_later(key, gallery, stamp)
+    return gallery
+
+def _fetch_all_embeddings(with_stamp: bool = False):
+    # every stored embedding as (ids, unit matrix, norms)
+    with db() as conn:
+        stamp, rows = _stamped(
+            conn,
             """
-            INSERT INTO public.student_embeddings (student_id, embedding)
-            VALUES (%s, %s)
-            ON CONFLICT (student_id)
-            DO UPDATE SET embedding = EXCLUDED.embedding, created_at = NOW()
+            SELECT student_id, embedding_vec, embedding_norm,
+                   CASE WHEN embedding_vec IS NULL THEN embedding END
+            FROM public.student_embeddings
             """,
-            (student_id, Json(emb)),
         )
+    rows = stack_stored(rows)
+    return (rows, stamp) if with_stamp else rows
 
-    return {"ok": True, "student_id": student_id, "saved_dims": len(emb)}
+def _fetch_global_gallery() -> Gallery:
+    snap = snapshots.load("global") if snapshots is not None else None
+    if snap is not None:
+        with db() as conn:
+            return _refresh_snapshot(conn, "global", None, *snap)
+    rows, stamp = _fetch_all_embeddings(with_stamp=True)
+    gallery = Gallery(*rows)
+    if snapshots is not None:
+        gallery.ensure_index()
+        snapshots.save_later("global", gallery, stamp)
+    return gallery
+
+def _load_global_gallery() -> Gallery:
+    # for identification without a course
+    if shared is not None:
+        gallery = shared.load("global", _fetch_global_gallery)
+    else:
+        gallery = _fetch_global_gallery()
+    gallery.ensure_index()
+    return gallery
+
+def _warm_from_snapshots():
+    # map every snapshot into the cache after startup and delta-refresh it,
+    # so the first check-in of the day finds its course already loaded
+    for key in snapshots.keys():
+        try:
+            if key == "global":
+                if GLOBAL_INDEX == "gallery":
+                    galleries.get_global(_load_global_gallery)
+            elif key.startswith("course-"):
+                with db() as conn:
+                    _course_gallery(conn, int(key[len("course-"):]))
+        except (HTTPException, ValueError):
+            continue
+
+_SESSION_ROW_SQL = """
+    SELECT start_time, late_after_minutes
+    FROM public.sessions
+    WHERE id=%s AND course_id=%s
+"""
+
+def _session_row(cur, session_id: int, course_id: int):
+    # make sure this session belongs to the course; rows are cached briefly
+    # since they don't change during a class
+    key = (session_id, course_id)
+    s = sessions.get(key)
+    if s is not None:
+        return s
+    cur.execute(_SESSION_ROW_SQL, key)
+    return _cache_session_row(key, cur.fetchone())
+
+async def _asession_row(acur, session_id: int, course_id: int):
+    key = (session_id, course_id)
+    s = sessions.get(key)
+    if s is not None:
+        return s
+    await acur.execute(_SESSION_ROW_SQL, key)
+    return _cache_session_row(key, await acur.fetchone())
+
+def _cache_session_row(key, s):
+    if not s:
+        raise HTTPException(status_code=404, detail="Session not found for course")
+    sessions.put(key, tuple(s))
+    return s
+
+def _status_for(start_time, late_after) -> str:
+    # present/late
+    now = datetime.now(timezone.utc)
+    cutoff = start_time + timedelta(minutes=(late_after or 0))
+    return "present" if now <= cutoff else "late"
+
+# _status_for in SQL, so the session check and the attendance upsert can
+# go out as one statement
+_STATUS_SQL = """
+    CASE WHEN %(now)s <= s.start_time + make_interval(mins => COALESCE(s.late_after_minutes, 0))
+         THEN 'present' ELSE 'late' END
+"""
+
+# checks the session belongs to the course, derives the status, inserts
+# the new rows and reports rows that already existed
+_CHECKIN_SQL = f"""
+    WITH sess AS (
+        SELECT s.id, s.start_time, s.late_after_minutes, {_STATUS_SQL} AS status
+        FROM public.sessions s
+        WHERE s.id = %(session_id)s AND s.course_id = %(course_id)s
+    ), marked AS (
+        INSERT INTO public.attendance (session_id, student_id, status, timestamp)
+        SELECT sess.id, sid, sess.status, NOW()
+        FROM sess, unnest(%(student_ids)s::bigint[]) AS sid
+        ON CONFLICT (session_id, student_id) DO NOTHING
+    )
+    SELECT sess.status, sess.start_time, sess.late_after_minutes, a.student_id, a.status
+    FROM sess
+    LEFT JOIN public.attendance a
+           ON a.session_id = sess.id AND a.student_id = ANY(%(student_ids)s::bigint[])
+"""
+
+# insert attendance for any number of students (UNIQUE(session_id,
+# student_id) assumed; ids must be distinct). First check-in wins: existing
+# rows are left alone and returned. The SELECT reads the snapshot from
+# before the insert, so it only sees rows that were already there.
+_MARK_SQL = """
+    WITH marked AS (
+        INSERT INTO public.attendance (session_id, student_id, status, timestamp)
+        SELECT %(session_id)s, sid, %(status)s, NOW() FROM unnest(%(student_ids)s::bigint[]) AS sid
+        ON CONFLICT (session_id, student_id) DO NOTHING
+    )
+    SELECT student_id, status FROM public.attendance
+    WHERE session_id = %(session_id)s AND student_id = ANY(%(student_ids)s::bigint[])
+"""
+
+def _checkin(session_id: int, course_id: int, student_ids: List[int]) -> Tuple[str, Dict[int, str]]:
+    # mark attendance for every student (ids distinct, may be empty).
+    # Returns the session's present/late right now and, for students who
+    # were already checked in, their original status: the first check-in
+    # wins, and repeats known to this process skip the DB entirely. A pooled
+    # connection is only checked out when SQL has to run.
+    key = (session_id, course_id)
+    new, repeats = marks.split(key, student_ids)
+    cached = sessions.get(key)
+    if cached is not None and (not new or writer is not None):
+        status = _status_for(*cached)
+        if new:
+            writer.submit(session_id, new, status)
+            _record_marks(key, new, status, {}, repeats)
+        return status, repeats
+    with db() as conn, conn.cursor() as cur:
+        if cached is not None or writer is not None:
+            # session row cached (or write-behind): the write is all that's left
+            status = _status_for(*(cached or _session_row(cur, session_id, course_id)))
+            if new:
+                _record_marks(key, new, status, _mark_attendance(cur, session_id, new, status), repeats)
+            return status, repeats
+        cur.execute(_CHECKIN_SQL, _checkin_params(key, new), prepare=True)
+        return _checked_in(key, new, cur.fetchall(), repeats), repeats
+
+async def _acheckin(session_id: int, course_id: int, student_ids: List[int]) -> Tuple[str, Dict[int, str]]:
+    # async twin of _checkin for the async endpoints
+    key = (session_id, course_id)
+    new, repeats = marks.split(key, student_ids)
+    cached = sessions.get(key)
+    if cached is not None and (not new or writer is not None):
+        status = _status_for(*cached)
+        if new:
+            # the journal fsync blocks; keep it off the event loop
+            await run_db(writer.submit, session_id, new, status)
+            _record_marks(key, new, status, {}, repeats)
+        return status, repeats
+    async with adb() as conn, conn.cursor() as cur:
+        if cached is not None or writer is not None:
+            status = _status_for(*(cached or await _asession_row(cur, session_id, course_id)))
+            if new:
+                _record_marks(key, new, status, await _amark_attendance(cur, session_id, new, status), repeats)
+            return status, repeats
+        await cur.execute(_CHECKIN_SQL, _checkin_params(key, new), prepare=True)
+        return _checked_in(key, new, await cur.fetchall(), repeats), repeats
+
+def _checkin_params(key, student_ids: List[int]) -> dict:
+    return {"now": datetime.now(timezone.utc), "session_id": key[0],
+            "course_id": key[1], "student_ids": student_ids}
+
+def _checked_in(key, new: List[int], rows, repeats: Dict[int, str]) -> str:
+    # rows of _CHECKIN_SQL: cache the session row, learn existing marks
+    if not rows:
+        raise HTTPException(status_code=404, detail="Session not found for course")
+    status, start_time, late_after = rows[0][:3]
+    sessions.put(key, (start_time, late_after))
+    _record_marks(key, new, status, {r[3]: r[4] for r in rows if r[3] is not None}, repeats)
+    return status
+
+def _record_marks(key, new: List[int], status: str, earlier: Dict[int, str], repeats: Dict[int, str]) -> None:
+    marks.add(key, {**{sid: status for sid in new}, **earlier})
+    repeats.update(earlier)
+
+def _course_gallery(conn, course_id: int) -> Gallery:
+    # course gallery comes from the in-process cache; only a cold course
+    # reads public.student_embeddings
+    if shared is not None:
+        # worker processes map one published copy; a single process loads
+        # a cold course and re-publishes after the course was invalidated
+        loader = lambda cid: shared.load(cid, lambda: _load_gallery(conn, cid))
+        gallery = galleries.get(course_id, loader)
+        if _is_stale(course_id, gallery):
+            galleries.invalidate(course_id)
+            gallery = galleries.get(course_id, loader)
+    else:
+        gallery = galleries.get(course_id, lambda cid: _load_gallery(conn, cid))
+    if len(gallery) == 0:
+        raise HTTPException(status_code=404, detail="No embeddings for this course")
+    return gallery
+
+async def _acourse_gallery(course_id: int) -> Gallery:
+    # warm galleries come straight from the cache; a cold load (rare) runs
+    # the sync loader on the DB executor
+    gallery = _warm_course_gallery(course_id)
+    if gallery is None:
+        return await run_db(_course_gallery_db, course_id)
+    return gallery
+
+def _warm_course_gallery(course_id: int) -> Optional[Gallery]:
+    # the cached gallery if it is current, None if it has to be loaded
+    gallery = galleries.peek(course_id)
+    if gallery is None or _is_stale(course_id, gallery):
+        return None
+    if len(gallery) == 0:
+        raise HTTPException(status_code=404, detail="No embeddings for this course")
+    return gallery
+
+def _course_gallery_db(course_id: int) -> Gallery:
+    with db() as conn:
+        return _course_gallery(conn, course_id)
+
+def _mark_attendance(cur, session_id: int, student_ids: List[int], status: str) -> Dict[int, str]:
+    # {student_id: original status} for students who already had a row
+    if writer is not None:
+        writer.submit(session_id, student_ids, status)
+        return {}
+    cur.execute(_MARK_SQL, {"session_id": session_id, "status": status, "student_ids": student_ids},
+                prepare=True)
+    return dict(cur.fetchall())
+
+async def _amark_attendance(acur, session_id: int, student_ids: List[int], status: str) -> Dict[int, str]:
+    if writer is not None:
+        # the journal fsync blocks; keep it off the event loop
+        await run_db(writer.submit, session_id, student_ids, status)
+        return {}
+    await acur.execute(_MARK_SQL, {"session_id": session_id, "status": status, "student_ids": student_ids},
+                       prepare=True)
+    return dict(await acur.fetchall())
+
+def _flag_repeats(results: List[dict], repeats: Dict[int, str]) -> None:
+    for r in results:
+        if r["ok"]:
+            r["already_checked_in"] = r["matched_student_id"] in repeats
 
 # ===== 2) Match embedding & mark attendance =====
-@app.post("/api/attendance/checkin-vec")
-def checkin_vec(
-    body: EmbeddingIn,
+@app.post("/api/attendance/checkin-vec", openapi_extra=_EMBEDDING_BODY)
+async def checkin_vec(
+    request: Request,
     course_id: int = Query(...),
     session_id: int = Query(...),
 ):
-    live = body.embedding
-    if not isinstance(live, list) or len(live) < 64:
-        raise HTTPException(status_code=400, detail="Invalid embedding length")
-    live = live[:128]
+    live = await _read_embedding(request)
 
-    with db() as conn, conn.cursor() as cur:
-        # make sure this session belongs to the course
-        cur.execute(
-            """
-            SELECT start_time, late_after_minutes
-            FROM public.sessions
-            WHERE id=%s AND course_id=%s
-            """,
-            (session_id, course_id),
-        )
-        s = cur.fetchone()
-        if not s:
-            raise HTTPException(status_code=404, detail="Session not found for course")
-        start_time, late_after = s
+    # concurrent check-ins for the same session are scored and written
+    # together; a lone request runs straight through
+    run = lambda lives: _checkin_lives(course_id, session_id, lives)
+    if coalescer is None:
+        result = (await run([live]))[0]
+        if isinstance(result, HTTPException):
+            raise result
+        return result
+    return await coalescer.submit((course_id, session_id), live, run)
 
-        # get embeddings for students enrolled in this course
-        cur.execute(
-            """
-            SELECT se.student_id, se.embedding
-            FROM public.student_embeddings se
-            JOIN public.enrollments e ON e.student_id = se.student_id
-            WHERE e.course_id = %s
-            """,
-            (course_id,),
-        )
-        rows = cur.fetchall()
-        if not rows:
-            raise HTTPException(status_code=404, detail="No embeddings for this course")
-
-        # psycopg3 will usually decode jsonb to Python lists automatically.
-        # But be defensive in case the driver returns a string.
-        best_id, best_sim = None, -1.0
-        for sid, emb_obj in rows:
-            if isinstance(emb_obj, str):
-                try:
-                    emb = json.loads(emb_obj)
-                except Exception:
-                    continue
-            else:
-                emb = emb_obj  # likely already a list from jsonb
-
-            sim = cosine_similarity(live, emb)
-            if sim > best_sim:
-                best_id, best_sim = sid, sim
-
-        # require a decent match
-        if best_id is None or best_sim < 0.60:
-            raise HTTPException(status_code=404, detail="No matching student")
-
-        # present/late
-        now = datetime.now(timezone.utc)
-        cutoff = start_time + timedelta(minutes=(late_after or 0))
-        status = "present" if now <= cutoff else "late"
-
-        # upsert attendance (UNIQUE(session_id, student_id) assumed)
-        cur.execute(
-            """
-            INSERT INTO public.attendance (session_id, student_id, status, timestamp)
-            VALUES (%s, %s, %s, NOW())
-            ON CONFLICT (session_id, student_id)
-            DO UPDATE SET status = EXCLUDED.status, timestamp = NOW()
-            """,
-            (session_id, best_id, status),
-        )
+async def _checkin_lives(course_id: int, session_id: int, lives: List[np.ndarray]) -> list:
+    # one response (or HTTPException) per live vector, one attendance write
+    gallery = await _acourse_gallery(course_id)
+
+    # score the live vectors against the whole course in one pass, on the
+    # matching executor (kept apart from the DB calls)
+    matches = await match_gallery(gallery, lives)
+    # require a decent match
+    matches = [m if m is not None and m.accepted() else None for m in matches]
+    matched = sorted({m.student_id for m in matches if m is not None})
+
+    status, repeats = await _acheckin(session_id, course_id, matched)
+
+    return [
+        HTTPException(status_code=404, detail="No matching student") if m is None else {
+            "ok": True,
+            "matched_student_id": m.student_id,
+            "similarity": round(m.similarity, 4),
+            "distance": round(m.distance, 4),
+            "status": repeats.get(m.student_id, status),
+            "already_checked_in": m.student_id in repeats,
+            "course_id": course_id,
+            "session_id": session_id,
+        }
+        for m in matches
+    ]
+
+# ===== 3) Match a batch of embeddings (kiosk queue) & mark attendance =====
+MAX_BATCH = int(os.getenv("CHECKIN_MAX_BATCH", "64"))
+
+class EmbeddingBatchIn(BaseModel):
+    embeddings: List[List[float]]
+
+@app.post("/api/attendance/checkin-vec/batch")
+async def checkin_vec_batch(
+    body: EmbeddingBatchIn,
+    course_id: int = Query(...),
+    session_id: int = Query(...),
+):
+    lives = body.embeddings
+    if not lives or len(lives) > MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {MAX_BATCH} embeddings")
+    lives = _embeddings_from_lists(lives)
+
+    gallery = await _acourse_gallery(course_id)
+
+    # every embedding against the whole course in one matrix-matrix product
+    matches = await match_gallery(gallery, lives)
+
+    results, matched = [], []
+    for i, m in enumerate(matches):
+        if m is None or not m.accepted():
+            results.append({"index": i, "ok": False, "detail": "No matching student"})
+            continue
+        results.append({
+            "index": i,
+            "ok": True,
+            "matched_student_id": m.student_id,
+            "similarity": round(m.similarity, 4),
+            "distance": round(m.distance, 4),
+        })
+        matched.append(m.student_id)
+
+    # validates the session too, so it runs even when nobody matched
+    status, repeats = await _acheckin(session_id, course_id, sorted(set(matched)))
+    _flag_repeats(results, repeats)
+
+    return {
+        "ok": True,
+        "status": status,
+        "course_id": course_id,
+        "session_id": session_id,
+        "results": results,
+    }
+
+def _embeddings_from_lists(lives: List[List[float]]) -> List[np.ndarray]:
+    # same checks as a checkin-vec body (length, finite numbers) per vector
+    try:
+        return [embedding_from_list(live) for live in lives]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ===== 4) Whole-room frame: one-to-one assignment of faces to students =====
+@app.post("/api/attendance/checkin-frame")
+async def checkin_frame(
+    body: EmbeddingBatchIn,
+    course_id: int = Query(...),
+    session_id: int = Query(...),
+):
+    faces = body.embeddings
+    if not faces or len(faces) > MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {MAX_BATCH} faces")
+    faces = _embeddings_from_lists(faces)
+
+    gallery = await _acourse_gallery(course_id)
+
+    # full faces x students similarity matrix, solved as an assignment
+    # so each student is credited at most once per frame
+    matches = await run_matching(gallery.assign_many, faces)
+
+    results, matched = [], []
+    for i, m in enumerate(matches):
+        if m is None:
+            results.append({"index": i, "ok": False, "detail": "No matching student"})
+            continue
+        results.append({
+            "index": i,
+            "ok": True,
+            "matched_student_id": m.student_id,
+            "similarity": round(m.similarity, 4),
+            "distance": round(m.distance, 4),
+        })
+        matched.append(m.student_id)
+
+    status, repeats = await _acheckin(session_id, course_id, sorted(matched))
+    _flag_repeats(results, repeats)
 
     return {
         "ok": True,
-        "matched_student_id": best_id,
-        "similarity": round(best_sim, 4),
         "status": status,
         "course_id": course_id,
         "session_id": session_id,
+        "matched": len(matched),
+        "results": results,
+    }
+
+# ===== 5) Streaming kiosk check-in over WebSocket =====
+# Client sends {"embedding": [...], "track_id": "..."} per frame. Each frame
+# gets a {"type": "frame"} progress reply; attendance is written only when
+# the track's vote is stable, answered with {"type": "checked_in"}.
+@app.websocket("/ws/attendance/checkin")
+async def checkin_stream(
+    ws: WebSocket,
+    course_id: int = Query(...),
+    session_id: int = Query(...),
+):
+    await ws.accept()
+
+    def open_session():
+        with db() as conn, conn.cursor() as cur:
+            return _session_row(cur, session_id, course_id), _course_gallery(conn, course_id)
+
+    def write(student_id: int) -> str:
+        status, repeats = _checkin(session_id, course_id, [student_id])
+        return repeats.get(student_id, status)
+
+    try:
+        _, gallery = await run_db(open_session)
+    except HTTPException as e:
+        await ws.send_json({"type": "error", "detail": e.detail})
+        await ws.close(code=1008)
+        return
+
+    voter = TrackVoter()
+    try:
+        while True:
+            # a bad frame gets an error reply; the socket stays open
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            track = None
+            try:
+                msg = _parse_frame(message.get("text"))
+                track = str(msg.get("track_id", "0"))
+                live = msg.get("embedding")
+                if not isinstance(live, list):
+                    raise ValueError("Embedding must be a list of numbers")
+                live = embedding_from_list(live)
+            except ValueError as e:
+                await ws.send_json({"type": "error", "track_id": track, "detail": str(e)})
+                continue
+
+            # pick up roster/embedding changes without reloading from the DB
+            gallery = galleries.peek(course_id, count=False) or gallery
+            vote = voter.add(track, (await match_gallery(gallery, [live]))[0])
+            if vote["candidate"] is not None:
+                vote["similarity"] = round(vote["similarity"], 4)
+                vote["distance"] = round(vote["distance"], 4)
+            if not vote.pop("stable"):
+                await ws.send_json({"type": "frame", "track_id": track, **vote})
+                continue
+
+            status = await run_db(write, vote["candidate"])
+            voter.commit(track, vote["candidate"])
+            await ws.send_json({
+                "type": "checked_in",
+                "track_id": track,
+                "matched_student_id": vote["candidate"],
+                "votes": vote["votes"],
+                "similarity": vote["similarity"],
+                "distance": vote["distance"],
+                "status": status,
+                "course_id": course_id,
+                "session_id": session_id,
+            })
+    except WebSocketDisconnect:
+        pass
+
+def _parse_frame(text: Optional[str]) -> dict:
+    if text is None:
+        raise ValueError("Frames must be JSON text")
+    try:
+        msg = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        raise ValueError("Invalid JSON frame")
+    if not isinstance(msg, dict):
+        raise ValueError('Frame must be {"embedding": [numbers], "track_id": "..."}')
+    return msg
+
+# ===== 6) Campus-wide identification (entrance kiosks, no course_id) =====
+# A session counts as running from SESSION_EARLY_MINUTES before its start
+# until SESSION_WINDOW_MINUTES after it; the closest start wins.
+SESSION_EARLY_MINUTES = int(os.getenv("SESSION_EARLY_MINUTES", "15"))
+SESSION_WINDOW_MINUTES = int(os.getenv("SESSION_WINDOW_MINUTES", "90"))
+
+@app.post("/api/attendance/identify")
+async def identify(body: EmbeddingIn):
+    live = _embeddings_from_lists([body.embedding])[0]
+
+    # who is this: search every embedding through the global index
+    index = global_index.current() if GLOBAL_INDEX == "ivfpq" else None
+    if index is not None:
+        match = await run_matching(index.best_match, live)
+    else:
+        gallery = galleries.peek_global()
+        if gallery is None or _is_stale("global", gallery):
+            gallery = await run_db(_global_gallery)
+        # a large shared global gallery may be scanned in the process pool
+        match = (await match_gallery(gallery, [live]))[0]
+    if match is None or not match.accepted():
+        raise HTTPException(status_code=404, detail="No matching student")
+    best_id = match.student_id
+    session_id, course_id, status, earlier = await run_db(_identify_checkin, best_id)
+
+    return {
+        "ok": True,
+        "matched_student_id": best_id,
+        "similarity": round(match.similarity, 4),
+        "distance": round(match.distance, 4),
+        "status": earlier or status,
+        "already_checked_in": earlier is not None,
+        "course_id": course_id,
+        "session_id": session_id,
     }
 
+def _global_gallery() -> Gallery:
+    # cold or stale global gallery, loaded on the DB executor
+    gallery = galleries.get_global(_load_global_gallery)
+    if _is_stale("global", gallery):
+        galleries.invalidate_global()
+        gallery = galleries.get_global(_load_global_gallery)
+    return gallery
 
+def _identify_checkin(best_id: int) -> Tuple[int, int, str, Optional[str]]:
+    # (session, course, status now, earlier status or None) of the student's
+    # running session, checked in unless they already were. With
+    # write-behind on, the statement only finds the session and the
+    # check-in goes through the journal
+    marked = "" if writer is not None else """, marked AS (
+                INSERT INTO public.attendance (session_id, student_id, status, timestamp)
+                SELECT sess.id, %(student_id)s, sess.status, NOW() FROM sess
+                ON CONFLICT (session_id, student_id) DO NOTHING
+            )"""
+    with db() as conn, conn.cursor() as cur:
+        # which class are they in: their enrolled session running right now;
+        # found and marked in the same statement
+        cur.execute(
+            f"""
+            WITH sess AS (
+                SELECT s.id, s.course_id, {_STATUS_SQL} AS status
+                FROM public.sessions s
+                JOIN public.enrollments e ON e.course_id = s.course_id
+                WHERE e.student_id = %(student_id)s
+                  AND s.start_time <= NOW() + make_interval(mins => %(early)s)
+                  AND s.start_time >= NOW() - make_interval(mins => %(window)s)
+                ORDER BY abs(extract(epoch FROM NOW() - s.start_time))
+                LIMIT 1
+            ){marked}
+            SELECT sess.id, sess.course_id, sess.status, a.status
+            FROM sess
+            LEFT JOIN public.attendance a
+                   ON a.session_id = sess.id AND a.student_id = %(student_id)s
+            """,
+            {"now": datetime.now(timezone.utc), "student_id": best_id,
+             "early": SESSION_EARLY_MINUTES, "window": SESSION_WINDOW_MINUTES},
+            prepare=True,
+        )
+        s = cur.fetchone()
+        if not s:
+            raise HTTPException(status_code=404, detail="No running session for this student")
+        session_id, course_id, status, earlier = s
+        key = (session_id, course_id)
+        if earlier is None and writer is not None:
+            # not flushed yet, but maybe already journaled by this process
+            earlier = marks.split(key, [best_id])[1].get(best_id)
+            if earlier is None:
+                writer.submit(session_id, [best_id], status)
+        marks.add(key, {best_id: earlier or status})
+    return session_id, course_id, status, earlier
@@ -0,0 +1,519 @@
+import os
+import threading
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.hnsw import HNSWIndex
+
+# face-api.js descriptor length
+EMBEDDING_DIM = 128
+
+# "cosine" (higher is better) or "euclidean" (lower is better, what
+# face-api.js descriptors are tuned for). Both come out of the same dot
+# product against pre-normalized rows, so there is only one scoring path.
+METRIC = os.getenv("MATCH_METRIC", "cosine")
+
+# minimum cosine similarity for a check-in to count as a match
+MATCH_THRESHOLD = float(os.getenv("MATCH_THRESHOLD", "0.60"))
+
+# maximum euclidean distance when METRIC == "euclidean" (face-api.js default)
+MATCH_MAX_DISTANCE = float(os.getenv("MATCH_MAX_DISTANCE", "0.6"))
+
+# galleries at least this large get an HNSW index (built in the background)
+# and single-face lookups go through it instead of brute force
+ANN_MIN_GALLERY = int(os.getenv("ANN_MIN_GALLERY", "20000"))
+# HNSW candidates re-scored exactly before picking the best match
+ANN_CANDIDATES = int(os.getenv("ANN_CANDIDATES", "10"))
+
+# how gallery rows are held in memory: "float32", "float16" or "int8"
+# (per-dimension scaled). Quantized galleries are scanned in chunks and the
+# top QUANT_RERANK rows per query are re-scored in float32.
+GALLERY_DTYPE = os.getenv("GALLERY_DTYPE", "float32")
+QUANT_RERANK = int(os.getenv("QUANT_RERANK", "8"))
+_SCAN_CHUNK = 4096
+
+# patched galleries keep spare rows past the end, so a save appends in place
+# instead of copying the matrix; rows of re-saved or removed students are
+# vacated (id -1, masked when scoring) until they pass this share of the
+# gallery, at which point the next patch compacts it with one copy
+_SPARE_ROWS_MIN = 64
+_VACANT_MAX_SHARE = 0.125
+
+
+class Match(NamedTuple):
+    student_id: int
+    similarity: float
+    distance: float
+
+    def accepted(self, metric: Optional[str] = None) -> bool:
+        if (metric or METRIC) == "euclidean":
+            return self.distance <= MATCH_MAX_DISTANCE
+        return self.similarity >= MATCH_THRESHOLD
+
+
+def normalize(emb, dim: int = EMBEDDING_DIM) -> Tuple[np.ndarray, float]:
+    """Return (unit vector, L2 norm) for one embedding, padded/truncated to dim."""
+    v = _as_query(np.asarray(emb, dtype=np.float32), dim)
+    n = float(np.linalg.norm(v))
+    if n > 0:
+        v /= n
+    return v, n
+
+
+def normalize_rows(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    matrix = np.array(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+    nz = norms > 0
+    matrix[nz] /= norms[nz, None]
+    return matrix, norms
+
+
+def quantize(matrix: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode unit rows as (codes, per-dimension scale); rows ~= codes * scale."""
+    dim = matrix.shape[1]
+    if dtype == "float16":
+        return matrix.astype(np.float16), np.ones(dim, dtype=np.float32)
+    if dtype == "int8":
+        absmax = np.abs(matrix).max(axis=0) if matrix.shape[0] else np.ones(dim, dtype=np.float32)
+        scale = (np.where(absmax > 0, absmax, 1.0) / 127.0).astype(np.float32)
+        return _encode_int8(matrix, scale), scale
+    raise ValueError(f"unknown gallery dtype {dtype!r}")
+
+
+def _encode_int8(matrix: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    # rows patched in later may exceed the build-time range; they clip
+    return np.clip(np.rint(matrix / scale), -127, 127).astype(np.int8)
+
+
+class _Tail:
+    """Rows taken in a buffer shared by several versions of a gallery.
+
+    Each version sees only its own first rows; only the version ending
+    where the taken rows end may append past it, any other one copies.
+    """
+
+    __slots__ = ("lock", "used")
+
+    def __init__(self, used: int):
+        self.lock = threading.Lock()
+        self.used = used
+
+    def claim(self, start: int, k: int, capacity: int) -> bool:
+        with self.lock:
+            if self.used != start or start + k > capacity:
+                return False
+            self.used = start + k
+            return True
+
+
+class Gallery:
+    """All enrolled embeddings of one course as a single float32 matrix.
+
+    Rows are L2-normalized and ``norms`` keeps each row's original length,
+    so scoring a live vector is one matrix-vector product (BLAS, GIL
+    released): the dot product is the cosine similarity directly, and the
+    euclidean distance of the raw vectors follows from it and the norms.
+    Row i belongs to ``ids[i]``.
+
+    With GALLERY_DTYPE int8/float16 the rows are stored quantized (``scale``
+    holds the per-dimension factor), which fits 2-4x more courses in the
+    cache budget at the cost of a small float32 re-rank per query.
+
+    Patched versions share row buffers with spare capacity: a save writes
+    its row past the end of the rows older versions can see, and a row it
+    replaces is vacated (``ids`` -1) in the new version only, so readers of
+    an older version are never torn and a save costs O(dim), not a copy.
+    ``len()`` counts live rows only.
+    """
+
+    def __init__(self, ids: np.ndarray, matrix: np.ndarray, norms: Optional[np.ndarray] = None,
+                 index: Optional[HNSWIndex] = None, scale: Optional[np.ndarray] = None,
+                 dtype: Optional[str] = None):
+        self.ids = np.ascontiguousarray(ids, dtype=np.int64)
+        # shared, incrementally maintained by every patched copy of the gallery
+        self.index = index
+        # published version this gallery was mapped from or, once patched,
+        # the version it is known to be current for (shared galleries)
+        self.version: Optional[int] = None
+        # (path, layout meta) of the shared file this gallery is a mapping of
+        self.source: Optional[Tuple[str, dict]] = None
+        if norms is None:
+            # raw vectors: normalize once here instead of on every check-in
+            matrix, norms = normalize_rows(matrix)
+        if scale is None:
+            matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+            if (dtype or GALLERY_DTYPE) != "float32":
+                matrix, scale = quantize(matrix, dtype or GALLERY_DTYPE)
+        self.matrix = np.ascontiguousarray(matrix)
+        self.scale = scale
+        self.norms = np.ascontiguousarray(norms, dtype=np.float32)
+        if self.matrix.ndim != 2 or self.matrix.shape[0] != self.ids.shape[0]:
+            raise ValueError("matrix must be (n, dim) with one row per id")
+        if self.norms.shape != self.ids.shape:
+            raise ValueError("norms must have one entry per id")
+        self._set_rows((self.matrix, self.ids, self.norms), _Tail(self.ids.shape[0]), self.ids.shape[0])
+
+    def _set_rows(self, buffers: Tuple[np.ndarray, np.ndarray, np.ndarray], tail: _Tail, n: int) -> None:
+        # matrix/ids/norms are views of the first n rows of the buffers
+        self._buffers, self._tail = buffers, tail
+        self.matrix, self.ids, self.norms = buffers[0][:n], buffers[1][:n], buffers[2][:n]
+        self._vacant = np.flatnonzero(self.ids < 0)
+        self._row_of: Optional[Dict[int, int]] = None
+
+    def _version(self, buffers: Tuple[np.ndarray, np.ndarray, np.ndarray], tail: _Tail, n: int) -> "Gallery":
+        g = Gallery.__new__(Gallery)
+        g.index, g.scale = self.index, self.scale
+        # patches keep the version they were made on; no longer the file's rows
+        g.version, g.source = self.version, None
+        g._set_rows(buffers, tail, n)
+        return g
+
+    def __len__(self) -> int:
+        return self.ids.shape[0] - self._vacant.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        index = self.index.nbytes if self.index is not None else 0
+        scale = self.scale.nbytes if self.scale is not None else 0
+        return sum(b.nbytes for b in self._buffers) + scale + index
+
+    @property
+    def quantized(self) -> bool:
+        return self.scale is not None
+
+    def rows_f32(self, rows: np.ndarray) -> np.ndarray:
+        # float32 unit vectors for the given rows (dequantized and
+        # re-normalized when the gallery is quantized)
+        if not self.quantized:
+            return self.matrix[rows]
+        return normalize_rows(self.matrix[rows].astype(np.float32) * self.scale)[0]
+
+    def with_embedding(self, student_id: int, unit: np.ndarray, norm: float) -> "Gallery":
+        vec = _as_query(np.asarray(unit, dtype=np.float32), self.dim)
+        if self.index is not None:
+            self.index.add(student_id, vec)
+        return self._upserted(np.array([student_id], dtype=np.int64), self._encode_rows(vec[None, :]),
+                              np.array([norm], dtype=np.float32))
+
+    def without(self, student_id: int) -> "Gallery":
+        hit = np.flatnonzero(self.ids == student_id)
+        if not hit.size:
+            return self
+        if self.index is not None:
+            self.index.remove(student_id)
+        if self._over_vacant(hit.size):
+            keep = (self.ids != student_id) & (self.ids >= 0)
+            return self._compacted(keep, np.zeros(0, dtype=np.int64), self.matrix[:0], np.zeros(0, dtype=np.float32))
+        matrix, ids, norms = self._buffers
+        ids = ids.copy()
+        ids[hit] = -1
+        return self._version((matrix, ids, norms), self._tail, self.ids.shape[0])
+
+    def with_rows(self, student_ids: np.ndarray, units: np.ndarray, norms: np.ndarray,
+                  keep_ids: Optional[np.ndarray] = None) -> "Gallery":
+        # batch form of with_embedding/without: upsert many (distinct) rows
+        # at once and, given keep_ids, drop every student not listed there
+        student_ids = np.asarray(student_ids, dtype=np.int64)
+        units = np.asarray(units, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.asarray(norms, dtype=np.float32)
+        replaced = np.isin(self.ids, student_ids)
+        keep = ~replaced & (self.ids >= 0)
+        if keep_ids is not None:
+            keep &= np.isin(self.ids, keep_ids)
+        if self.index is not None:
+            for sid in self.ids[~keep & ~replaced & (self.ids >= 0)]:
+                self.index.remove(int(sid))
+            for sid, vec in zip(student_ids, units):
+                self.index.add(int(sid), vec)
+        codes = self._encode_rows(units)
+        if keep_ids is None:
+            return self._upserted(student_ids, codes, norms, replaced)
+        return self._compacted(keep, student_ids, codes, norms)
+
+    def _upserted(self, student_ids: np.ndarray, codes: np.ndarray, norms: np.ndarray,
+                  replaced: Optional[np.ndarray] = None) -> "Gallery":
+        # append the rows past the end (vacating the ones they replace) in
+        # place when this version owns the end of its buffers, else into a
+        # larger copy; too many vacant rows and it's compacted instead
+        if replaced is None:
+            replaced = np.isin(self.ids, student_ids)
+        hit = np.flatnonzero(replaced)
+        if self._over_vacant(hit.size):
+            return self._compacted(~replaced & (self.ids >= 0), student_ids, codes, norms)
+        n, k = self.ids.shape[0], student_ids.shape[0]
+        buffers, tail, own_ids = self._buffers, self._tail, False
+        if not tail.claim(n, k, buffers[1].shape[0]):
+            capacity = n + k + max(_SPARE_ROWS_MIN, n // 8)
+            buffers = tuple(_with_capacity(b[:n], capacity) for b in buffers)
+            tail, own_ids = _Tail(n + k), True
+        matrix, ids, norms_buf = buffers
+        matrix[n : n + k], ids[n : n + k], norms_buf[n : n + k] = codes, student_ids, norms
+        if hit.size:
+            # older versions still score the replaced rows; only ours loses them
+            if not own_ids:
+                ids = ids.copy()
+            ids[hit] = -1
+        return self._version((matrix, ids, norms_buf), tail, n + k)
+
+    def _compacted(self, keep: np.ndarray, student_ids: np.ndarray, codes: np.ndarray,
+                   norms: np.ndarray) -> "Gallery":
+        g = Gallery(
+            np.concatenate([self.ids[keep], student_ids]),
+            np.concatenate([self.matrix[keep], codes]),
+            np.concatenate([self.norms[keep], norms]),
+            self.index,
+            self.scale,
+        )
+        g.version = self.version
+        return g
+
+    def _over_vacant(self, k: int) -> bool:
+        return self._vacant.shape[0] + k > max(_SPARE_ROWS_MIN, _VACANT_MAX_SHARE * self.ids.shape[0])
+
+    def _encode_rows(self, units: np.ndarray) -> np.ndarray:
+        if not self.quantized:
+            return units
+        if self.matrix.dtype == np.int8:
+            return _encode_int8(units, self.scale)
+        return units.astype(self.matrix.dtype)
+
+    def ensure_index(self) -> None:
+        # large galleries get an HNSW graph built off the request path; until
+        # it's ready, lookups stay on brute force
+        if self.index is not None or len(self) < ANN_MIN_GALLERY:
+            return
+        self.index = HNSWIndex(self.dim)
+        rows = np.flatnonzero(self.ids >= 0)
+        if self.quantized or self._vacant.size:
+            ids, matrix = self.ids[rows], self.rows_f32(rows)
+        else:
+            ids, matrix = self.ids, self.matrix
+        threading.Thread(target=_build_index, args=(self.index, ids, matrix),
+                         name="hnsw-build", daemon=True).start()
+
+    def _use_index(self) -> bool:
+        return self.index is not None and self.index.ready and len(self) >= ANN_MIN_GALLERY
+
+    def _rows_for(self, student_ids: np.ndarray) -> np.ndarray:
+        if self._row_of is None:
+            self._row_of = {sid: i for i, sid in enumerate(self.ids.tolist()) if sid >= 0}
+        rows = [self._row_of.get(int(sid)) for sid in student_ids]
+        return np.array([r for r in rows if r is not None], dtype=np.int64)
+
+    def cosine(self, unit: np.ndarray) -> np.ndarray:
+        # cosine similarity of a unit query against every row
+        if not self.quantized:
+            return self.matrix @ unit
+        return self.cosine_block(unit[None, :])[0]
+
+    def cosine_block(self, units: np.ndarray) -> np.ndarray:
+        """(m, n) cosine similarities of m unit queries against every row.
+
+        Quantized galleries are scanned chunk by chunk (decode a block to
+        float32, one GEMM with the scale folded into the queries), then the
+        top QUANT_RERANK rows of each query are re-scored in float32 against
+        the re-normalized rows so the winner is picked on exact scores.
+        """
+        if not self.quantized:
+            return units @ self.matrix.T
+        qs = units * self.scale
+        n = self.ids.shape[0]
+        cos = np.empty((units.shape[0], n), dtype=np.float32)
+        for a in range(0, n, _SCAN_CHUNK):
+            block = self.matrix[a : a + _SCAN_CHUNK].astype(np.float32)
+            cos[:, a : a + _SCAN_CHUNK] = qs @ block.T
+        if self._vacant.size:
+            cos[:, self._vacant] = -np.inf
+        k = min(QUANT_RERANK, n)
+        top = np.argpartition(-cos, k - 1, axis=1)[:, :k]
+        cand = np.unique(top)
+        exact = units @ self.rows_f32(cand).T
+        pos = np.searchsorted(cand, top)
+        rows = np.arange(units.shape[0])[:, None]
+        cos[rows, top] = exact[rows, pos]
+        return cos
+
+    def best_match(self, live: Sequence[float], metric: Optional[str] = None) -> Optional[Match]:
+        if len(self) == 0:
+            return None
+        unit, q_norm = normalize(live, self.dim)
+        if self._use_index():
+            # approximate candidates from the graph, exact scores for those rows
+            labels, _ = self.index.search(unit, k=ANN_CANDIDATES)
+            rows = self._rows_for(labels)
+            if rows.shape[0]:
+                return self._pick(rows, self.rows_f32(rows) @ unit, unit, q_norm, metric)
+        return self._pick(None, self.cosine(unit), unit, q_norm, metric)
+
+    def _pick(self, rows: Optional[np.ndarray], cos: np.ndarray, unit: np.ndarray,
+              q_norm: float, metric: Optional[str]) -> Match:
+        norms = self.norms if rows is None else self.norms[rows]
+        vacant = self._vacant if rows is None else None
+        if (metric or METRIC) == "euclidean":
+            d2 = q_norm * q_norm + norms * norms - 2.0 * q_norm * norms * cos
+            if vacant is not None and vacant.size:
+                d2[vacant] = np.inf
+            i = int(np.argmin(d2))
+        else:
+            if vacant is not None and vacant.size:
+                cos[vacant] = -np.inf
+            i = int(np.argmax(cos))
+        row = i if rows is None else int(rows[i])
+        dist = _pair_distance(q_norm, float(norms[i]), float(cos[i]))
+        return Match(int(self.ids[row]), float(cos[i]), dist)
+
+    def match_many(self, lives: Sequence[Sequence[float]], metric: Optional[str] = None) -> List[Optional[Match]]:
+        # several live vectors against the gallery in one matrix-matrix product
+        if len(self) == 0:
+            return [None] * len(lives)
+        if self._use_index():
+            # graph search per query beats scanning a gallery this large
+            return [self.best_match(live, metric) for live in lives]
+        units, q_norms = normalize_rows(_as_queries(lives, self.dim))
+        cos = self.cosine_block(units)
+        rows = np.arange(cos.shape[0])
+        if (metric or METRIC) == "euclidean":
+            dist = self.pairwise_distances(cos, q_norms)
+            dist[:, self._vacant] = np.inf
+            best = np.argmin(dist, axis=1)
+            best_dist = dist[rows, best]
+        else:
+            cos[:, self._vacant] = -np.inf
+            best = np.argmax(cos, axis=1)
+            d2 = q_norms**2 + self.norms[best] ** 2 - 2.0 * q_norms * self.norms[best] * cos[rows, best]
+            best_dist = np.sqrt(np.maximum(d2, 0.0))
+        best_cos = cos[rows, best]
+        return [
+            Match(int(self.ids[b]), float(c), float(d))
+            for b, c, d in zip(best, best_cos, best_dist)
+        ]
+
+    def assign_many(self, lives: Sequence[Sequence[float]], metric: Optional[str] = None) -> List[Optional[Match]]:
+        """One-to-one matching of several faces from the same frame.
+
+        Scores the full faces x students block with one GEMM, then solves
+        the assignment that maximizes total margin over the acceptance
+        threshold, so no student is credited twice and no face gets two
+        students. Faces left without an acceptable student get None.
+        """
+        if len(self) == 0 or len(lives) == 0:
+            return [None] * len(lives)
+        units, q_norms = normalize_rows(_as_queries(lives, self.dim))
+        cos = self.cosine_block(units)
+        if (metric or METRIC) == "euclidean":
+            dist = self.pairwise_distances(cos, q_norms)
+            margin = MATCH_MAX_DISTANCE - dist
+        else:
+            dist = None
+            margin = cos - MATCH_THRESHOLD
+        # below-threshold pairs are worth nothing, so they never displace a
+        # real match and are dropped afterwards; so are NaN scores (a face
+        # with non-finite values)
+        benefit = np.where(margin > 0, margin, 0.0).astype(np.float64)
+        benefit[:, self._vacant] = 0.0
+
+        out: List[Optional[Match]] = [None] * len(lives)
+        for r, c in linear_assignment(-benefit):
+            if not benefit[r, c] > 0:
+                continue
+            if dist is None:
+                d = _pair_distance(float(q_norms[r]), float(self.norms[c]), float(cos[r, c]))
+            else:
+                d = float(dist[r, c])
+            out[r] = Match(int(self.ids[c]), float(cos[r, c]), d)
+        return out
+
+    def pairwise_distances(self, cos: np.ndarray, q_norms: np.ndarray) -> np.ndarray:
+        # (m, n) euclidean distances from an (m, n) cosine block
+        qn = q_norms[:, None]
+        d2 = qn * qn + self.norms[None, :] ** 2 - 2.0 * qn * self.norms[None, :] * cos
+        return np.sqrt(np.maximum(d2, 0.0))
+
+
+def _with_capacity(arr: np.ndarray, capacity: int) -> np.ndarray:
+    out = np.zeros((capacity,) + arr.shape[1:], dtype=arr.dtype)
+    out[: arr.shape[0]] = arr
+    return out
+
+
+def _build_index(index: HNSWIndex, ids: np.ndarray, matrix: np.ndarray) -> None:
+    for sid, vec in zip(ids, matrix):
+        if index.cancelled:
+            return
+        index.add(int(sid), vec, replace=False)
+    index.mark_ready()
+
+
+def linear_assignment(cost: np.ndarray) -> List[Tuple[int, int]]:
+    """Minimum-cost one-to-one assignment (Hungarian / shortest augmenting path).
+
+    ``cost`` is (rows, cols); every row of the smaller side is assigned.
+    The inner column scan is vectorized, so a 40 x 400 frame is a few
+    thousand NumPy ops. Returns (row, col) pairs.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)  # p[j]: row (1-based) assigned to column j
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used
+            free[0] = False
+            cur = np.full(m + 1, np.inf)
+            cur[1:] = cost[i0 - 1] - u[i0] - v[1:]
+            upd = free & (cur < minv)
+            minv[upd] = cur[upd]
+            way[upd] = j0
+            cand = np.where(free, minv, np.inf)
+            j1 = int(np.argmin(cand))
+            delta = cand[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    pairs = [(int(p[j]) - 1, j - 1) for j in range(1, m + 1) if p[j]]
+    if transposed:
+        pairs = [(c, r) for r, c in pairs]
+    return sorted(pairs)
+
+
+def _pair_distance(q_norm: float, x_norm: float, cos: float) -> float:
+    d2 = q_norm * q_norm + x_norm * x_norm - 2.0 * q_norm * x_norm * cos
+    return float(np.sqrt(max(d2, 0.0)))
+
+
+def _as_queries(lives: Sequence[Sequence[float]], dim: int) -> np.ndarray:
+    Q = np.zeros((len(lives), dim), dtype=np.float32)
+    for i, live in enumerate(lives):
+        v = np.asarray(live, dtype=np.float32)[:dim]
+        Q[i, : v.shape[0]] = v
+    return Q
+
+
+def _as_query(live: np.ndarray, dim: int) -> np.ndarray:
+    q = np.zeros(dim, dtype=np.float32)
+    v = live[:dim]
+    q[: v.shape[0]] = v
+    return q
@@ -0,0 +1,57 @@
+# Backfill student_embeddings.embedding_vec / embedding_norm from the legacy
+# JSONB column or from raw (not yet normalized) bytea rows.
+#
+#   python -m app.migrate_embeddings [batch_size]
+#
+# Safe to re-run; it only touches rows whose embedding_norm is still NULL.
+import sys
+
+from app.db import close_pool, db
+from app.embeddings import decode_stored, pack_embedding
+from app.matching import EMBEDDING_DIM, normalize
+
+
+def backfill(batch_size: int = 500) -> int:
+    done = 0
+    with db() as conn:
+        while True:
+            with conn.transaction(), conn.cursor(binary=True) as cur:
+                cur.execute(
+                    """
+                    SELECT student_id, embedding_vec, embedding
+                    FROM public.student_embeddings
+                    WHERE embedding_norm IS NULL
+                      AND (embedding_vec IS NOT NULL OR embedding IS NOT NULL)
+                    ORDER BY student_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    (batch_size,),
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    return done
+                params = []
+                for sid, vec, legacy in rows:
+                    v = decode_stored(vec, legacy)
+                    if v is not None:
+                        unit, norm = normalize(v, EMBEDDING_DIM)
+                        params.append((pack_embedding(unit), norm, sid))
+                cur.executemany(
+                    """
+                    UPDATE public.student_embeddings
+                    SET embedding_vec = %s, embedding_norm = %s, embedding = NULL
+                    WHERE student_id = %s
+                    """,
+                    params,
+                )
+                done += len(params)
+                if len(params) < len(rows):
+                    # undecodable rows would be picked again forever
+                    return done
+
+
+if __name__ == "__main__":
+    n = backfill(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
+    close_pool()
+    print(f"converted {n} embeddings")
@@ -0,0 +1,201 @@
+import fcntl
+import json
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from app.matching import Gallery
+
+# Galleries published once into a shared directory (tmpfs by default) and
+# mapped read-only by every worker process, so N workers hold one copy of
+# each course and only one of them queries the DB per cold course.
+SHARED_GALLERIES = os.getenv("SHARED_GALLERIES", "0") == "1"
+SHARED_GALLERY_DIR = os.getenv(
+    "SHARED_GALLERY_DIR",
+    "/dev/shm/face-attendance" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "face-attendance"),
+)
+
+_ALIGN = 64
+
+
+def _layout(n: int, dim: int, dtype: np.dtype, quantized: bool):
+    parts = [("ids", np.dtype(np.int64), (n,)), ("norms", np.dtype(np.float32), (n,))]
+    if quantized:
+        parts.append(("scale", np.dtype(np.float32), (dim,)))
+    parts.append(("matrix", np.dtype(dtype), (n, dim)))
+    out, off = [], 0
+    for name, dt, shape in parts:
+        off = -(-off // _ALIGN) * _ALIGN
+        out.append((name, dt, shape, off))
+        off += dt.itemsize * int(np.prod(shape))
+    return out, max(off, _ALIGN)
+
+
+def write_gallery_file(path: str, gallery: Gallery) -> dict:
+    """Write ``gallery`` as one flat, aligned file; returns its layout meta."""
+    n, dim = gallery.matrix.shape
+    layout, size = _layout(n, dim, gallery.matrix.dtype, gallery.quantized)
+    arrays = {"ids": gallery.ids, "norms": gallery.norms, "scale": gallery.scale, "matrix": gallery.matrix}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.truncate(size)
+        for name, dt, _, off in layout:
+            f.seek(off)
+            f.write(np.ascontiguousarray(arrays[name], dtype=dt).tobytes())
+    os.replace(tmp, path)
+    return {"rows": int(n), "dim": int(dim), "dtype": gallery.matrix.dtype.str, "quantized": gallery.quantized}
+
+
+def map_gallery_file(path: str, meta: dict) -> Gallery:
+    """Map a gallery file read-only; the arrays are views into the mapping."""
+    layout, _ = _layout(meta["rows"], meta["dim"], np.dtype(meta["dtype"]), meta["quantized"])
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    parts = {
+        name: np.frombuffer(mm, dtype=dt, count=int(np.prod(shape)), offset=off).reshape(shape)
+        for name, dt, shape, off in layout
+    }
+    return Gallery(parts["ids"], parts["matrix"], parts["norms"], scale=parts.get("scale"), dtype="float32")
+
+
+class SharedGalleries:
+    """Versioned directory of galleries shared between worker processes.
+
+    ``directory.json`` maps a key (course id or "global") to the file and
+    version currently published. Readers re-read it only when its mtime
+    changes. Publishing and invalidating both bump a key's version (an
+    invalidated key has no file), so versions never repeat and a worker can't
+    mistake a reload for its old mapping; a worker that patched its own copy
+    for the change it invalidated adopts the new version instead of
+    reloading. Publishing and invalidation happen under file locks, and a
+    per-key lock makes sure a single process loads a cold course from the DB
+    while the others wait and then map the result.
+    """
+
+    def __init__(self, root: str = SHARED_GALLERY_DIR):
+        self.root = root
+        self._dir: Tuple[int, Dict[str, dict]] = (-1, {})
+
+    # ---- directory ----
+    @property
+    def _dir_path(self) -> str:
+        return os.path.join(self.root, "directory.json")
+
+    def directory(self) -> Dict[str, dict]:
+        try:
+            mtime = os.stat(self._dir_path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime != self._dir[0]:
+            with open(self._dir_path) as f:
+                self._dir = (mtime, json.load(f))
+        return self._dir[1]
+
+    def _write_directory(self, entries: Dict[str, dict]) -> None:
+        tmp = f"{self._dir_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp, self._dir_path)
+
+    @contextmanager
+    def _locked(self, name: str) -> Iterator[None]:
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, f".{name}.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # ---- read / publish ----
+    def is_stale(self, key, gallery: Gallery) -> bool:
+        entry = self.directory().get(str(key))
+        return entry is None or entry["version"] != gallery.version
+
+    def load(self, key, loader: Callable[[], Gallery]) -> Gallery:
+        key = str(key)
+        entry = self.directory().get(key)
+        if entry is not None and entry["file"] is not None:
+            try:
+                return self._map(entry)
+            except FileNotFoundError:
+                pass  # replaced under us; fall through to the locked path
+        with self._locked(f"load-{key}"):
+            # someone else may have published while we waited
+            entry = self._fresh_directory().get(key)
+            if entry is not None and entry["file"] is not None:
+                return self._map(entry)
+            return self.publish(key, loader())
+
+    def publish(self, key, gallery: Gallery) -> Gallery:
+        key = str(key)
+        with self._locked("directory"):
+            entries = dict(self._fresh_directory())
+            old = entries.get(key)
+            version = (old["version"] + 1) if old else 1
+            fname = f"gallery-{key}-v{version}.bin"
+            meta = write_gallery_file(os.path.join(self.root, fname), gallery)
+            entries[key] = {"version": version, "file": fname, **meta}
+            self._write_directory(entries)
+        if old and old["file"]:
+            # mappings of the old file stay valid until their readers drop them
+            _unlink(os.path.join(self.root, old["file"]))
+        mapped = self._map(entries[key])
+        # the publisher keeps its graph (e.g. restored from a snapshot)
+        mapped.index = gallery.index
+        return mapped
+
+    def invalidate(self, key) -> Optional[Tuple[int, int]]:
+        """Drop the published file of ``key``; returns (old, new) version,
+        or None if the key was never published."""
+        key = str(key)
+        with self._locked("directory"):
+            entries = dict(self._fresh_directory())
+            old = entries.get(key)
+            if old is None:
+                return None
+            entries[key] = {"version": old["version"] + 1, "file": None}
+            self._write_directory(entries)
+        if old["file"]:
+            _unlink(os.path.join(self.root, old["file"]))
+        return old["version"], old["version"] + 1
+
+    def stats(self) -> dict:
+        entries = self.directory()
+        return {
+            "root": self.root,
+            "entries": sum(1 for e in entries.values() if e["file"]),
+            "bytes": sum(_size(os.path.join(self.root, e["file"])) for e in entries.values() if e["file"]),
+        }
+
+    def _fresh_directory(self) -> Dict[str, dict]:
+        self._dir = (-1, {})
+        return self.directory()
+
+    def _map(self, entry: dict) -> Gallery:
+        path = os.path.join(self.root, entry["file"])
+        g = map_gallery_file(path, entry)
+        g.version = entry["version"]
+        g.source = (path, {k: entry[k] for k in ("rows", "dim", "dtype", "quantized")})
+        return g
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+shared = SharedGalleries() if SHARED_GALLERIES else None
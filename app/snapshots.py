@@ -0,0 +1,154 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.hnsw import HNSWIndex
+from app.matching import Gallery
+from app.shared_gallery import map_gallery_file, write_gallery_file
+
+# On-disk gallery snapshots so a cold instance maps its galleries from a
+# file and only asks the DB for rows changed since the snapshot, instead of
+# decoding every embedding before the first check-in. GALLERY_SNAPSHOT_DIR
+# must be on a disk that outlives the instance (on Render: a persistent
+# disk mounted there); the default relative path sits on the service's
+# ephemeral filesystem, which is wiped on every deploy and restart, so cold
+# starts would never find a snapshot.
+GALLERY_SNAPSHOTS = os.getenv("GALLERY_SNAPSHOTS", "1") == "1"
+GALLERY_SNAPSHOT_DIR = os.getenv("GALLERY_SNAPSHOT_DIR", "data/snapshots")
+
+
+class SnapshotStore:
+    """Gallery (+ HNSW graph) snapshots keyed by "course-<id>" or "global".
+
+    Each snapshot is a gallery file in the shared-gallery layout, an
+    optional ``.hnsw.npz`` graph and a ``<key>.json`` meta file written last,
+    so a crash mid-write leaves the previous snapshot intact. ``stamp`` is
+    the DB version stamp the gallery was read at: rows with a version at or
+    above it may be missing and are re-read on load.
+
+    Writes go through one background thread; a gallery whose ANN graph is
+    still building waits until the graph is ready so both are saved together.
+    Worker processes sharing the directory write a key one at a time (flock
+    on ``.<key>.lock``), and a snapshot older than the one on disk is dropped.
+    """
+
+    def __init__(self, root: str = GALLERY_SNAPSHOT_DIR):
+        self.root = root
+        self._pending: Dict[str, Tuple[Gallery, int]] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.loads = 0
+        self.writes = 0
+        self.last_error: Optional[str] = None
+
+    def keys(self) -> List[str]:
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(n[:-5] for n in names if n.endswith(".json"))
+
+    def load(self, key: str) -> Optional[Tuple[Gallery, int]]:
+        """Map the snapshot for ``key``; returns (gallery, stamp) or None."""
+        meta = self._meta(key)
+        if meta is None:
+            return None
+        try:
+            gallery = map_gallery_file(os.path.join(self.root, meta["file"]), meta)
+            if meta.get("hnsw"):
+                gallery.index = HNSWIndex.load(os.path.join(self.root, meta["hnsw"]))
+                # the graph may have been saved after later patches
+                for label in np.setdiff1d(gallery.index.labels(), gallery.ids):
+                    gallery.index.remove(int(label))
+        except (OSError, ValueError, KeyError) as e:
+            self.last_error = f"{key}: {e}"
+            return None
+        self.loads += 1
+        return gallery, int(meta["stamp"])
+
+    def save_later(self, key: str, gallery: Gallery, stamp: int) -> None:
+        with self._cond:
+            self._pending[key] = (gallery, stamp)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gallery-snapshots", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "root": self.root,
+            "snapshots": len(self.keys()),
+            "pending": pending,
+            "loads": self.loads,
+            "writes": self.writes,
+            "last_error": self.last_error,
+        }
+
+    # ---- internals ----
+    def _meta(self, key: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.root, f"{key}.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                ready = {k: v for k, v in self._pending.items()
+                         if v[0].index is None or v[0].index.ready or v[0].index.cancelled}
+                if not ready:
+                    # nothing, or only galleries whose graph is still building
+                    self._cond.wait(timeout=1.0 if self._pending else None)
+                    continue
+                for key in ready:
+                    del self._pending[key]
+            for key, (gallery, stamp) in ready.items():
+                try:
+                    self._write(key, gallery, stamp)
+                    self.writes += 1
+                except OSError as e:
+                    self.last_error = f"{key}: {e}"
+
+    def _write(self, key: str, gallery: Gallery, stamp: int) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, f".{key}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._write_locked(key, gallery, stamp)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write_locked(self, key: str, gallery: Gallery, stamp: int) -> None:
+        old = self._meta(key)
+        if old is not None and int(old["stamp"]) > stamp:
+            return  # another worker already saved a newer one
+        # fresh names per generation; the previous files stay until the meta
+        # pointing at them has been replaced
+        gen = f"{key}-{stamp}-{time.time_ns()}"
+        meta = write_gallery_file(os.path.join(self.root, f"{gen}.bin"), gallery)
+        meta.update(file=f"{gen}.bin", stamp=int(stamp), hnsw=None)
+        if gallery.index is not None and gallery.index.ready:
+            gallery.index.save(os.path.join(self.root, f"{gen}.hnsw.npz"))
+            meta["hnsw"] = f"{gen}.hnsw.npz"
+        path = os.path.join(self.root, f"{key}.json")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+        for name in (old or {}).get("file"), (old or {}).get("hnsw"):
+            if name:
+                try:
+                    os.unlink(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass
+
+
+snapshots = SnapshotStore() if GALLERY_SNAPSHOTS else None
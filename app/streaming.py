@@ -0,0 +1,62 @@
+import os
+from collections import Counter, deque
+from typing import Deque, Dict, Optional
+
+from app.matching import Match
+
+# frames kept per track, and how many of them must agree on one student
+WINDOW = int(os.getenv("WS_WINDOW_FRAMES", "5"))
+MIN_VOTES = int(os.getenv("WS_MIN_VOTES", "3"))
+# tracks remembered per socket; the least recently seen one is dropped
+MAX_TRACKS = int(os.getenv("WS_MAX_TRACKS", "32"))
+
+
+class TrackVoter:
+    """Temporal voting over a short window of per-frame matches.
+
+    Each kiosk track (one face followed across frames) keeps its last
+    WINDOW best matches. A student is committed only once MIN_VOTES frames
+    in the window accepted that same student, so a single noisy frame never
+    produces a check-in on its own. Only the ``max_tracks`` most recently
+    seen tracks are kept, whatever track ids the client makes up.
+    """
+
+    def __init__(self, window: int = WINDOW, min_votes: int = MIN_VOTES, max_tracks: int = MAX_TRACKS):
+        self.window = window
+        self.min_votes = min_votes
+        self.max_tracks = max_tracks
+        self._tracks: Dict[str, Deque[Optional[Match]]] = {}
+        self.committed: set = set()
+
+    def add(self, track_id: str, match: Optional[Match]) -> dict:
+        # re-inserted on every frame, so the dict is in least-recently-seen order
+        frames = self._tracks.pop(track_id, None)
+        if frames is None:
+            frames = deque(maxlen=self.window)
+        self._tracks[track_id] = frames
+        while len(self._tracks) > self.max_tracks:
+            self.drop(next(iter(self._tracks)))
+        frames.append(match if match is not None and match.accepted() else None)
+
+        votes = Counter(m.student_id for m in frames if m is not None)
+        if not votes:
+            return {"candidate": None, "votes": 0, "stable": False}
+        sid, n = votes.most_common(1)[0]
+        agreeing = [m for m in frames if m is not None and m.student_id == sid]
+        return {
+            "candidate": sid,
+            "votes": n,
+            "similarity": sum(m.similarity for m in agreeing) / n,
+            "distance": sum(m.distance for m in agreeing) / n,
+            "checked_in": sid in self.committed,
+            "stable": n >= self.min_votes and sid not in self.committed,
+        }
+
+    def commit(self, track_id: str, student_id: int) -> None:
+        # a committed student is never credited again on this socket; the
+        # track starts over so the next face in front of the kiosk is fresh
+        self.committed.add(student_id)
+        self._tracks.pop(track_id, None)
+
+    def drop(self, track_id: str) -> None:
+        self._tracks.pop(track_id, None)
@@ -0,0 +1,12 @@
+-- Packed little-endian float32 storage for face descriptors.
+--
+-- New writes go to embedding_vec and leave embedding (JSONB) NULL. Readers
+-- fall back to embedding while old rows are still unconverted; run
+--   python -m app.migrate_embeddings
+-- to backfill, after which the JSONB column can be dropped.
+
+ALTER TABLE public.student_embeddings
+    ADD COLUMN IF NOT EXISTS embedding_vec bytea;
+
+ALTER TABLE public.student_embeddings
+    ALTER COLUMN embedding DROP NOT NULL;
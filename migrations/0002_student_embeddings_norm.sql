@@ -0,0 +1,8 @@
+-- embedding_vec holds the L2-normalized descriptor from here on; the
+-- original length lives in embedding_norm so euclidean distances on the
+-- raw descriptors can still be derived. Rows with a NULL norm are treated
+-- as raw and normalized on read until python -m app.migrate_embeddings
+-- has rewritten them.
+
+ALTER TABLE public.student_embeddings
+    ADD COLUMN IF NOT EXISTS embedding_norm real;
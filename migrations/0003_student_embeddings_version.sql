@@ -0,0 +1,27 @@
+-- Row version for gallery snapshots (app/snapshots.py).
+--
+-- Every insert/update stamps the row with the id of the writing
+-- transaction. A snapshot remembers pg_snapshot_xmin() from before it read
+-- the table; on the next cold start only rows with version >= that stamp
+-- (plus rows missing from the snapshot) are fetched again. Using the xid
+-- rather than a sequence means a transaction that commits after the
+-- snapshot was taken can never hide behind a smaller number.
+
+ALTER TABLE public.student_embeddings
+    ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION public.student_embeddings_set_version()
+RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.version := pg_current_xact_id()::text::bigint;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS student_embeddings_version ON public.student_embeddings;
+CREATE TRIGGER student_embeddings_version
+    BEFORE INSERT OR UPDATE ON public.student_embeddings
+    FOR EACH ROW EXECUTE FUNCTION public.student_embeddings_set_version();
+
+CREATE INDEX IF NOT EXISTS student_embeddings_version_idx
+    ON public.student_embeddings (version);
@@ -0,0 +1,42 @@
+-- Cache invalidation across processes and nodes (app/invalidation.py).
+--
+-- Writes to student_embeddings and enrollments send a small JSON payload on
+-- the gallery_changes channel. Every API process LISTENs and patches or
+-- evicts only the cached galleries the change touches. "origin" is the
+-- writer's application_name so a process can skip its own writes, which it
+-- has already applied.
+
+CREATE OR REPLACE FUNCTION public.gallery_notify()
+RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    origin text := current_setting('application_name', true);
+BEGIN
+    IF TG_TABLE_NAME = 'student_embeddings' THEN
+        PERFORM pg_notify('gallery_changes', json_build_object(
+            'table', TG_TABLE_NAME, 'op', TG_OP, 'origin', origin,
+            'student_id', COALESCE(NEW.student_id, OLD.student_id))::text);
+    ELSE
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM pg_notify('gallery_changes', json_build_object(
+                'table', TG_TABLE_NAME, 'op', 'DELETE', 'origin', origin,
+                'student_id', OLD.student_id, 'course_id', OLD.course_id)::text);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM pg_notify('gallery_changes', json_build_object(
+                'table', TG_TABLE_NAME, 'op', 'INSERT', 'origin', origin,
+                'student_id', NEW.student_id, 'course_id', NEW.course_id)::text);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS student_embeddings_notify ON public.student_embeddings;
+CREATE TRIGGER student_embeddings_notify
+    AFTER INSERT OR UPDATE OR DELETE ON public.student_embeddings
+    FOR EACH ROW EXECUTE FUNCTION public.gallery_notify();
+
+DROP TRIGGER IF EXISTS enrollments_notify ON public.enrollments;
+CREATE TRIGGER enrollments_notify
+    AFTER INSERT OR UPDATE OR DELETE ON public.enrollments
+    FOR EACH ROW EXECUTE FUNCTION public.gallery_notify();
@@ -0,0 +1,19 @@
+-- Session rows are cached per process (app/session_cache.py). Edits to a
+-- session's course, start time or late window are announced on the same
+-- gallery_changes channel so every process drops its cached row.
+
+CREATE OR REPLACE FUNCTION public.session_notify()
+RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('gallery_changes', json_build_object(
+        'table', TG_TABLE_NAME, 'op', TG_OP,
+        'origin', current_setting('application_name', true),
+        'session_id', OLD.id, 'course_id', OLD.course_id)::text);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS sessions_notify ON public.sessions;
+CREATE TRIGGER sessions_notify
+    AFTER UPDATE OR DELETE ON public.sessions
+    FOR EACH ROW EXECUTE FUNCTION public.session_notify();
@@ -0,0 +1,21 @@
+-- Marks already checked in are kept per process (app/attendance_state.py)
+-- so repeat check-ins skip the DB. Attendance rows that are edited or
+-- deleted behind the API are announced on the gallery_changes channel, one
+-- payload per session (identical payloads in a transaction are delivered
+-- once), so every process drops that session's marks.
+
+CREATE OR REPLACE FUNCTION public.attendance_notify()
+RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('gallery_changes', json_build_object(
+        'table', TG_TABLE_NAME, 'op', TG_OP,
+        'origin', current_setting('application_name', true),
+        'session_id', OLD.session_id)::text);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS attendance_notify ON public.attendance;
+CREATE TRIGGER attendance_notify
+    AFTER UPDATE OR DELETE ON public.attendance
+    FOR EACH ROW EXECUTE FUNCTION public.attendance_notify();
@@ -0,0 +1,50 @@
+# Recall-vs-latency report for the HNSW index against brute force.
+#
+#   python scripts/bench_ann.py [gallery_size] [queries]
+#
+# Synthetic face-like data: identities are random unit vectors and each
+# query is a noisy re-capture of one of them, which is roughly how
+# face-api.js descriptors of the same person scatter.
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, ".")
+from app.hnsw import HNSWIndex  # noqa: E402
+from app.matching import EMBEDDING_DIM, normalize_rows  # noqa: E402
+
+
+def main(n: int = 20000, n_queries: int = 500) -> None:
+    rng = np.random.default_rng(0)
+    gallery, _ = normalize_rows(rng.normal(size=(n, EMBEDDING_DIM)))
+    picks = rng.integers(0, n, n_queries)
+    queries, _ = normalize_rows(gallery[picks] + rng.normal(scale=0.04, size=(n_queries, EMBEDDING_DIM)))
+    truth = np.argmax(queries @ gallery.T, axis=1)
+
+    t = time.perf_counter()
+    for q in queries:
+        np.argmax(gallery @ q)
+    brute_ms = (time.perf_counter() - t) / n_queries * 1e3
+    print(f"gallery={n} queries={n_queries}")
+    print(f"{'method':<16}{'recall@1':>10}{'ms/query':>10}")
+    print(f"{'brute force':<16}{1.0:>10.3f}{brute_ms:>10.3f}")
+
+    t = time.perf_counter()
+    index = HNSWIndex(EMBEDDING_DIM)
+    for i, vec in enumerate(gallery):
+        index.add(i, vec)
+    index.mark_ready()
+    print(f"(hnsw build: {time.perf_counter() - t:.1f}s, M={index.M}, ef_construction={index.ef_construction})")
+
+    for ef in (8, 16, 32, 64, 128):
+        t = time.perf_counter()
+        got = [index.search(q, k=1, ef=ef)[0][0] for q in queries]
+        ms = (time.perf_counter() - t) / n_queries * 1e3
+        recall = float(np.mean(np.array(got) == truth))
+        print(f"{f'hnsw ef={ef}':<16}{recall:>10.3f}{ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,42 @@
+# Accuracy and speed of quantized gallery storage against float32.
+#
+#   python scripts/bench_quantized.py [gallery sizes...]
+#
+# Same synthetic setup as bench_ann.py: random unit identities, queries are
+# noisy re-captures. "top1" is agreement with the float32 winner, "|dsim|"
+# the mean absolute error of the reported similarity.
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, ".")
+from app.matching import EMBEDDING_DIM, Gallery, normalize_rows  # noqa: E402
+
+
+def main(sizes) -> None:
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>7} {'dtype':<8}{'MB':>8}{'us/query':>10}{'top1':>8}{'|dsim|':>10}")
+    for n in sizes:
+        raw = rng.normal(size=(n, EMBEDDING_DIM)).astype(np.float32)
+        picks = rng.integers(0, n, 300)
+        queries = raw[picks] + rng.normal(scale=0.4, size=(300, EMBEDDING_DIM)).astype(np.float32)
+        units, norms = normalize_rows(raw)
+        ids = np.arange(n)
+
+        ref = None
+        for dtype in ("float32", "float16", "int8"):
+            g = Gallery(ids, units, norms, dtype=dtype)
+            g.best_match(queries[0])
+            t = time.perf_counter()
+            got = [g.best_match(q) for q in queries]
+            us = (time.perf_counter() - t) / len(queries) * 1e6
+            if ref is None:
+                ref = got
+            top1 = np.mean([a.student_id == b.student_id for a, b in zip(got, ref)])
+            dsim = np.mean([abs(a.similarity - b.similarity) for a, b in zip(got, ref)])
+            print(f"{n:>7} {dtype:<8}{g.nbytes / 2**20:>8.2f}{us:>10.1f}{top1:>8.3f}{dsim:>10.5f}")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [40, 400, 5000, 60000])
@@ -0,0 +1,121 @@
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import psycopg
+import pytest
+
+from app import attendance_writer
+from app.attendance_writer import AttendanceWriter, _read_rows
+
+
+class _FakeDB:
+    """Stands in for the pool: records upserted rows, rejects chosen
+    (session, student) pairs the way a foreign key would."""
+
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.rows = []
+        self.calls = 0
+
+    @contextmanager
+    def __call__(self):
+        yield self
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def execute(self, sql, params, prepare=False):
+        self.calls += 1
+        rows = list(zip(*params))
+        if any((r[0], r[1]) in self.reject for r in rows):
+            raise psycopg.IntegrityError("violates foreign key constraint")
+        self.rows.extend(rows)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def install(**kw):
+        fake = _FakeDB(**kw)
+        monkeypatch.setattr(attendance_writer, "db", fake)
+        return fake
+    return install
+
+
+def _line(row):
+    return json.dumps(list(row)).encode() + b"\n"
+
+
+def _drain(w, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        st = w.stats()
+        if st["queued"] == 0 and st["flushed"] == st["journaled"]:
+            return st
+        time.sleep(0.01)
+    raise AssertionError(f"writer did not drain: {w.stats()}")
+
+
+def test_read_rows_stops_at_a_torn_line(tmp_path):
+    path = tmp_path / "j.log"
+    good = _line((1, 2, "present", "2026-01-01T00:00:00+00:00"))
+    path.write_bytes(good + good + b'[1, 3, "pres')
+    with open(path, "rb") as f:
+        rows, size = _read_rows(f)
+    assert rows == [(1, 2, "present", "2026-01-01T00:00:00+00:00")] * 2
+    assert size == 2 * len(good)
+
+
+def test_orphan_journal_is_replayed_and_removed(tmp_path, fake_db):
+    db = fake_db()
+    orphan = tmp_path / "attendance-999999.log"
+    orphan.write_bytes(_line((1, 2, "present", "t1")) + _line((1, 3, "late", "t2")) + b"[1, 4")
+    w = AttendanceWriter(str(tmp_path), flush_ms=5)
+    w.start()
+    try:
+        st = _drain(w)
+    finally:
+        w.stop()
+    assert sorted(db.rows) == [(1, 2, "present", "t1"), (1, 3, "late", "t2")]
+    assert st["replayed"] == 2
+    assert not orphan.exists()
+    # everything flushed: our own journal is empty again
+    assert os.path.getsize(tmp_path / f"attendance-{os.getpid()}.log") == 0
+
+
+def test_live_and_vanished_orphans_are_skipped(tmp_path, fake_db, monkeypatch):
+    db = fake_db()
+    live = tmp_path / "attendance-999998.log"
+    live.write_bytes(_line((1, 2, "present", "t1")))
+    real_glob = attendance_writer.glob.glob
+    # another worker replayed and removed this one after our glob
+    monkeypatch.setattr(attendance_writer.glob, "glob",
+                        lambda pattern: real_glob(pattern) + [str(tmp_path / "attendance-999997.log")])
+    with open(live, "rb") as owner:
+        fcntl.flock(owner, fcntl.LOCK_EX)
+        w = AttendanceWriter(str(tmp_path), flush_ms=5)
+        w.start()
+        w.stop()
+    assert db.rows == [] and w.stats()["replayed"] == 0
+    assert live.exists()
+
+
+def test_rejected_rows_are_dead_lettered(tmp_path, fake_db):
+    db = fake_db(reject={(9, 3)})
+    w = AttendanceWriter(str(tmp_path), flush_ms=5)
+    w.start()
+    try:
+        w.submit(1, [1, 2], "present")
+        w.submit(9, [3], "present")
+        w.submit(1, [4], "late")
+        st = _drain(w)
+    finally:
+        w.stop()
+    assert sorted((r[0], r[1]) for r in db.rows) == [(1, 1), (1, 2), (1, 4)]
+    assert st["dead_lettered"] == 1
+    with open(tmp_path / "dead-letter.log", "rb") as f:
+        rows, _ = _read_rows(f)
+    assert [(r[0], r[1], r[2]) for r in rows] == [(9, 3, "present")]
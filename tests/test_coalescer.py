@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from app.coalescer import Coalescer
+
+
+class _Runner:
+    """run_batch double: records each batch and answers item * 10 after a
+    short delay, or the exception instance an item asks for."""
+
+    def __init__(self, delay=0.02, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+
+    async def __call__(self, items):
+        self.batches.append(list(items))
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("batch failed")
+        return [item if isinstance(item, BaseException) else item * 10 for item in items]
+
+
+def test_lone_request_runs_immediately():
+    async def main():
+        c, run = Coalescer(window_ms=1000), _Runner()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await c.submit("k", 1, run) == 10
+        # nothing else in flight: no window wait
+        assert loop.time() - started < 0.5
+        return c, run
+
+    c, run = asyncio.run(main())
+    assert run.batches == [[1]]
+    assert c._keys == {}
+
+
+def test_concurrent_requests_share_a_batch():
+    async def main():
+        c, run = Coalescer(window_ms=20), _Runner(delay=0.05)
+        first = asyncio.ensure_future(c.submit("k", 1, run))
+        await asyncio.sleep(0)
+        rest = [asyncio.ensure_future(c.submit("k", i, run)) for i in range(2, 7)]
+        other = asyncio.ensure_future(c.submit("other", 7, run))
+        return await asyncio.gather(first, *rest, other), c, run
+
+    results, c, run = asyncio.run(main())
+    assert results == [10, 20, 30, 40, 50, 60, 70]
+    # the first runs alone; the ones arriving meanwhile go out together
+    assert sorted(run.batches) == [[1], [2, 3, 4, 5, 6], [7]]
+    assert c.stats()["max_batch_seen"] == 5
+    assert c._keys == {}
+
+
+def test_full_batch_skips_the_window():
+    async def main():
+        c, run = Coalescer(window_ms=5000, max_batch=3), _Runner()
+        first = asyncio.ensure_future(c.submit("k", 1, run))
+        await asyncio.sleep(0)
+        rest = [asyncio.ensure_future(c.submit("k", i, run)) for i in range(2, 5)]
+        return await asyncio.wait_for(asyncio.gather(first, *rest), 2.0), run
+
+    results, run = asyncio.run(main())
+    assert results == [10, 20, 30, 40]
+    assert run.batches == [[1], [2, 3, 4]]
+
+
+def test_errors_per_item_and_per_batch():
+    async def main(run):
+        c = Coalescer(window_ms=20)
+        first = asyncio.ensure_future(c.submit("k", 1, run))
+        await asyncio.sleep(0)
+        rest = [asyncio.ensure_future(c.submit("k", item, run)) for item in (2, ValueError("bad"), 4)]
+        return await asyncio.gather(first, *rest, return_exceptions=True)
+
+    results = asyncio.run(main(_Runner()))
+    assert results[:2] == [10, 20] and results[3] == 40
+    assert isinstance(results[2], ValueError)
+
+    results = asyncio.run(main(_Runner(fail=True)))
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_cancelled_leader_does_not_strand_followers():
+    async def main():
+        c, run = Coalescer(window_ms=20), _Runner(delay=0.05)
+        first = asyncio.ensure_future(c.submit("k", 1, run))
+        await asyncio.sleep(0)
+        leader = asyncio.ensure_future(c.submit("k", 2, run))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(c.submit("k", 3, run))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(first, follower), c, run
+
+    results, c, run = asyncio.run(main())
+    assert results == [10, 30]
+    # the batch still ran with the cancelled leader's item in it
+    assert run.batches == [[1], [2, 3]]
+    assert c._keys == {}
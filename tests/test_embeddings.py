@@ -0,0 +1,136 @@
+import base64
+
+import numpy as np
+import orjson
+import pytest
+
+from app.embeddings import MIN_WIRE_DIMS, pack_embedding, parse_embedding, stack_stored
+from app.matching import EMBEDDING_DIM
+
+BINARY = "application/octet-stream"
+BASE64 = "text/plain; charset=utf-8"
+JSON = "application/json"
+
+
+def _vec(n=EMBEDDING_DIM, seed=0):
+    return np.random.default_rng(seed).normal(size=n).astype(np.float32)
+
+
+def _json(emb):
+    return orjson.dumps({"embedding": emb})
+
+
+def test_binary_and_base64_match_json():
+    v = _vec()
+    raw = pack_embedding(v)
+    for body, ctype in ((raw, BINARY), (base64.b64encode(raw), BASE64), (_json(v.tolist()), JSON)):
+        out = parse_embedding(body, ctype)
+        assert out.dtype == np.float32 and out.shape == (EMBEDDING_DIM,)
+        np.testing.assert_array_equal(out, v)
+
+
+def test_binary_is_a_view_of_the_body():
+    raw = pack_embedding(_vec())
+    out = parse_embedding(raw, BINARY)
+    assert not out.flags.owndata
+
+
+def test_declared_dim():
+    v = _vec(96)
+    raw = pack_embedding(v)
+    assert parse_embedding(raw, BINARY, "96").shape == (96,)
+    assert parse_embedding(raw, BINARY, " 96 ").shape == (96,)
+    with pytest.raises(ValueError, match="X-Embedding-Dim"):
+        parse_embedding(raw, BINARY, "128")
+    with pytest.raises(ValueError, match="X-Embedding-Dim"):
+        parse_embedding(raw, BINARY, "abc")
+
+
+def test_longer_vectors_are_cut():
+    v = _vec(EMBEDDING_DIM + 32)
+    np.testing.assert_array_equal(parse_embedding(pack_embedding(v), BINARY), v[:EMBEDDING_DIM])
+    np.testing.assert_array_equal(parse_embedding(_json(v.tolist()), JSON), v[:EMBEDDING_DIM])
+
+
+@pytest.mark.parametrize("body, ctype", [
+    (pack_embedding(_vec(MIN_WIRE_DIMS - 1)), BINARY),
+    (pack_embedding(_vec())[:-1], BINARY),
+    (b"", BINARY),
+    (_json(_vec(MIN_WIRE_DIMS - 1).tolist()), JSON),
+    (_json([]), JSON),
+])
+def test_short_or_ragged_bodies(body, ctype):
+    with pytest.raises(ValueError, match="length"):
+        parse_embedding(body, ctype)
+
+
+def test_non_finite_values():
+    v = _vec()
+    v[3] = np.nan
+    with pytest.raises(ValueError, match="non-finite"):
+        parse_embedding(pack_embedding(v), BINARY)
+    v[3] = np.inf
+    with pytest.raises(ValueError, match="non-finite"):
+        parse_embedding(base64.b64encode(pack_embedding(v)), BASE64)
+    # JSON has no NaN; a huge number overflows float32 instead
+    with np.errstate(over="ignore"), pytest.raises(ValueError, match="non-finite"):
+        parse_embedding(_json([1e300] * EMBEDDING_DIM), JSON)
+
+
+def test_bad_base64():
+    with pytest.raises(ValueError, match="base64"):
+        parse_embedding(b"not base64!", BASE64)
+
+
+@pytest.mark.parametrize("body", [b"", b"{", b"[1, 2", b"NaN", b'{"embedding": [NaN]}'])
+def test_bad_json(body):
+    with pytest.raises(ValueError, match="Invalid JSON"):
+        parse_embedding(body, JSON)
+
+
+@pytest.mark.parametrize("doc", [
+    [0.1] * EMBEDDING_DIM,
+    {"embedding": "0.1,0.2"},
+    {"embedding": None},
+    {"vector": [0.1] * EMBEDDING_DIM},
+])
+def test_not_an_embedding_list(doc):
+    with pytest.raises(ValueError, match="Body must be"):
+        parse_embedding(orjson.dumps(doc), JSON)
+
+
+@pytest.mark.parametrize("emb", [
+    ["0.1"] * EMBEDDING_DIM,
+    [True] * EMBEDDING_DIM,
+    [None] * EMBEDDING_DIM,
+    [[0.1, 0.2]] * EMBEDDING_DIM,
+    [{"x": 1}] * EMBEDDING_DIM,
+])
+def test_non_numeric_values(emb):
+    with pytest.raises(ValueError, match="list of numbers"):
+        parse_embedding(_json(emb), JSON)
+
+
+def test_integers_are_accepted():
+    out = parse_embedding(_json([1] * EMBEDDING_DIM), JSON)
+    assert out.dtype == np.float32 and (out == 1.0).all()
+
+
+def test_stack_stored_fast_and_legacy_rows():
+    v = _vec()
+    unit = v / np.linalg.norm(v)
+    norm = float(np.linalg.norm(v))
+    fast = [(1, pack_embedding(unit), norm, None), (2, pack_embedding(unit), norm, None)]
+    ids, units, norms = stack_stored(fast)
+    assert ids.tolist() == [1, 2]
+    np.testing.assert_allclose(units, [unit, unit], rtol=1e-6)
+    np.testing.assert_allclose(norms, [norm, norm], rtol=1e-6)
+
+    # legacy JSONB and unnormalized bytea rows are normalized; rows with
+    # nothing stored are dropped
+    mixed = fast[:1] + [(3, None, None, orjson.dumps(v.tolist()).decode()),
+                        (4, pack_embedding(v), None, None), (5, None, None, None)]
+    ids, units, norms = stack_stored(mixed)
+    assert ids.tolist() == [1, 3, 4]
+    np.testing.assert_allclose(units, [unit] * 3, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(norms, [norm] * 3, rtol=1e-5)
@@ -0,0 +1,100 @@
+import threading
+
+import numpy as np
+
+from app.hnsw import HNSWIndex
+
+
+def _units(n, dim=32, seed=0):
+    x = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def _build(x, labels=None):
+    index = HNSWIndex(x.shape[1], M=8, ef_construction=64, ef_search=64)
+    for label, vec in zip(range(x.shape[0]) if labels is None else labels, x):
+        index.add(label, vec)
+    index.mark_ready()
+    return index
+
+
+def _recall(index, x, labels, queries, k=5):
+    hits = 0
+    for q in queries:
+        exact = set(labels[np.argsort(-(x @ q))[:k]].tolist())
+        found, _ = index.search(q, k=k)
+        hits += len(exact & set(found.tolist()))
+    return hits / (k * len(queries))
+
+
+def test_recall_against_brute_force():
+    x = _units(1500)
+    index = _build(x)
+    queries = _units(50, seed=1)
+    assert _recall(index, x, np.arange(1500), queries) >= 0.9
+    # a stored vector finds itself
+    labels, sims = index.search(x[123], k=1)
+    assert labels[0] == 123 and sims[0] > 0.999
+
+
+def test_deleted_and_replaced_labels():
+    x = _units(500)
+    index = _build(x)
+    for label in range(0, 500, 2):
+        index.remove(label)
+    assert len(index) == 250 and index.tombstones == 250
+    for q in x[:20]:
+        labels, _ = index.search(q, k=10)
+        assert all(label % 2 == 1 for label in labels)
+    # replacing moves the label to its new vector
+    index.add(7, x[100])
+    labels, _ = index.search(x[100], k=1)
+    assert labels[0] == 7
+
+
+def test_compact_drops_tombstones_in_place():
+    x = _units(800)
+    index = _build(x)
+    for label in range(400):
+        index.remove(label)
+    index.compact()
+    assert index.tombstones == 0 and len(index) == 400 and index.compactions == 1
+    assert sorted(index.labels().tolist()) == list(range(400, 800))
+    assert _recall(index, x[400:], np.arange(400, 800), x[400:450]) >= 0.9
+
+
+def test_tombstones_trigger_background_compaction(monkeypatch):
+    monkeypatch.setattr("app.hnsw.HNSW_COMPACT_MIN", 100)
+    monkeypatch.setattr("app.hnsw.HNSW_COMPACT_RATIO", 0.25)
+    x = _units(300)
+    index = _build(x)
+    for label in range(100):
+        index.remove(label)
+    for t in threading.enumerate():
+        if t.name == "hnsw-compact":
+            t.join()
+    assert index.compactions == 1 and index.tombstones < 100
+    assert not set(index.search(x[5], k=10)[0].tolist()) & set(range(100))
+
+
+def test_search_runs_alongside_inserts():
+    x = _units(1200)
+    index = _build(x[:200])
+    errors = []
+
+    def search():
+        try:
+            for q in x[:300]:
+                index.search(q, k=5)
+        except Exception as e:  # pragma: no cover - reported below
+            errors.append(e)
+
+    readers = [threading.Thread(target=search) for _ in range(3)]
+    for t in readers:
+        t.start()
+    for label in range(200, 1200):
+        index.add(label, x[label])
+    for t in readers:
+        t.join()
+    assert not errors
+    assert _recall(index, x, np.arange(1200), x[:50]) >= 0.9
@@ -0,0 +1,63 @@
+import time
+
+import numpy as np
+
+from app.ivfpq import IndexSlot, IVFPQIndex
+
+
+def _units(n, dim=32, seed=0):
+    x = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def _train(n=2000, seed=0):
+    x = _units(n, seed=seed)
+    ids = np.arange(1000, 1000 + n)
+    return ids, x, IVFPQIndex.train(ids, x, np.ones(n, dtype=np.float32), nlist=32, m=8)
+
+
+def test_recall_against_brute_force():
+    ids, x, index = _train()
+    queries = x[:200] + 0.05 * np.random.default_rng(1).normal(size=(200, 32)).astype(np.float32)
+    exact = ids[np.argmax(queries @ x.T, axis=1)]
+    found = np.array([index.best_match(q).student_id for q in queries])
+    assert (found == exact).mean() >= 0.95
+
+
+def test_delete_replace_and_delta():
+    ids, x, index = _train()
+    index.remove(1005)
+    assert index.best_match(x[5]).student_id != 1005
+    # a replaced row is served from the delta buffer with its new vector
+    index.add(1007, x[9], 1.0)
+    assert index.best_match(x[7]).student_id != 1007
+    assert index.best_match(x[9]).student_id in (1007, 1009)
+    index.add(5, x[5], 1.0)
+    assert index.best_match(x[5]).student_id == 5
+    assert len(index) == 2000 - 1 + 1
+
+
+def test_slot_reloads_a_rebuild_from_another_worker(tmp_path):
+    path = str(tmp_path / "ivfpq")
+    ids, x, _ = _train(500)
+    fetch = lambda: (ids, x, np.ones(ids.shape[0], dtype=np.float32))
+    builder, other = IndexSlot(path), IndexSlot(path)
+
+    assert builder.rebuild(fetch)
+    while builder.building:
+        time.sleep(0.01)
+    assert builder.last_error is None
+    assert other.current() is not None and len(other.current()) == 500
+
+    # live updates on the other worker survive its switch to a newer build
+    other.current().add(77, x[3], 1.0)
+    other.current().remove(1004)
+    time.sleep(0.01)  # distinct meta.json mtime
+    assert builder.rebuild(fetch)
+    while builder.building:
+        time.sleep(0.01)
+    first = other.index
+    index = other.current()
+    assert index is not first
+    assert index.best_match(x[3]).student_id in (77, 1003)
+    assert index.best_match(x[4]).student_id != 1004
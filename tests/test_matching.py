@@ -0,0 +1,98 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from app.matching import Gallery, linear_assignment
+
+
+def _brute_force(cost: np.ndarray) -> float:
+    # cheapest one-to-one assignment covering the smaller side
+    n, m = cost.shape
+    if n <= m:
+        return min(cost[np.arange(n), list(p)].sum() for p in itertools.permutations(range(m), n))
+    return min(cost[list(p), np.arange(m)].sum() for p in itertools.permutations(range(n), m))
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (1, 5), (3, 3), (4, 6), (6, 4), (5, 5)])
+def test_linear_assignment_matches_brute_force(shape):
+    rng = np.random.default_rng(sum(shape))
+    for _ in range(20):
+        cost = rng.normal(size=shape)
+        pairs = linear_assignment(cost)
+        assert len(pairs) == min(shape)
+        rows, cols = zip(*pairs)
+        assert len(set(rows)) == len(rows) and len(set(cols)) == len(cols)
+        assert sum(cost[r, c] for r, c in pairs) == pytest.approx(_brute_force(cost))
+
+
+def test_linear_assignment_ties_and_integers():
+    cost = np.array([[0, 0, 1], [0, 0, 1], [1, 1, 0]])
+    pairs = linear_assignment(cost)
+    assert sum(cost[r, c] for r, c in pairs) == 0
+    assert (2, 2) in pairs
+
+
+def test_assign_many_credits_each_student_once():
+    rng = np.random.default_rng(1)
+    matrix = rng.normal(size=(8, 128)).astype(np.float32)
+    gallery = Gallery(np.arange(100, 108), matrix, dtype="float32")
+    # two faces closest to the same student: only one may get them
+    lives = [matrix[3], matrix[3] + 0.05 * rng.normal(size=128), matrix[5]]
+    out = gallery.assign_many(lives)
+    ids = [m.student_id for m in out if m is not None]
+    assert len(ids) == len(set(ids))
+    assert out[0].student_id == 103 and out[2].student_id == 105
+
+
+@pytest.mark.parametrize("metric", ["cosine", "euclidean"])
+def test_assign_many_never_credits_a_non_finite_face(metric):
+    matrix = np.random.default_rng(2).normal(size=(8, 128)).astype(np.float32)
+    gallery = Gallery(np.arange(100, 108), matrix, dtype="float32")
+    with np.errstate(all="ignore"):
+        out = gallery.assign_many([matrix[3], [1e300] + [1.0] * 127, matrix[5]], metric=metric)
+    assert out[1] is None
+    assert out[0].student_id == 103 and out[2].student_id == 105
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int8"])
+def test_patched_versions_share_rows_without_tearing(dtype):
+    rng = np.random.default_rng(2)
+    matrix = rng.normal(size=(50, 128)).astype(np.float32)
+    base = Gallery(np.arange(50), matrix, dtype=dtype)
+    new = rng.normal(size=128).astype(np.float32)
+    unit = new / np.linalg.norm(new)
+
+    added = base.with_embedding(50, unit, 2.0)
+    replaced = added.with_embedding(7, unit, 2.0)
+    assert len(base) == 50 and len(added) == 51 and len(replaced) == 51
+    # the new row went into spare capacity of the same buffer
+    assert np.shares_memory(added.matrix, replaced.matrix)
+    # the older versions still score student 7's old row; the newest never does
+    assert base.best_match(matrix[7]).student_id == 7
+    assert added.best_match(matrix[7]).student_id == 7
+    assert replaced.best_match(matrix[7]).student_id != 7
+    assert replaced.best_match(new).student_id in (7, 50)
+    assert [m.student_id for m in replaced.match_many([matrix[7], matrix[8]])][1] == 8
+    assert 7 not in [m.student_id for m in replaced.assign_many([matrix[7]]) if m is not None]
+
+    # an older version patched again copies instead of overwriting the tail
+    fork = base.with_embedding(60, unit, 1.0)
+    assert not np.shares_memory(fork.matrix, added.matrix)
+    assert added.ids[-1] == 50 and fork.ids[-1] == 60
+
+    gone = replaced.without(3)
+    assert len(gone) == 50 and gone.best_match(matrix[3]).student_id != 3
+
+
+def test_vacant_rows_are_compacted():
+    rng = np.random.default_rng(3)
+    matrix = rng.normal(size=(100, 128)).astype(np.float32)
+    g = Gallery(np.arange(100), matrix, dtype="float32")
+    for sid in range(80):
+        g = g.with_embedding(sid, matrix[sid] / np.linalg.norm(matrix[sid]), 1.0)
+    assert len(g) == 100
+    assert (g.ids >= 0).sum() == 100 and g.ids.shape[0] <= 100 + 64 + 1
+    assert sorted(g.ids[g.ids >= 0].tolist()) == list(range(100))
+    for sid in (0, 40, 99):
+        assert g.best_match(matrix[sid]).student_id == sid